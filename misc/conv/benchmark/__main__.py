@@ -0,0 +1,256 @@
+import click
+import json
+import logging
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from benchmark.generators import generate_animation, generate_art_object, generate_level, generate_text, generate_texture, generate_trileset
+from common import read_xml_file
+from gltf_builder import OUTPUT_FORMATS
+from mesh_optimizer import generate_lods, optimize_geometry
+from pathlib import Path
+from spatial_index import SpatialIndex, write_spatial_index
+from typing import Any, Callable
+
+import convert_animation
+import convert_art_object
+import convert_level
+import convert_text
+import convert_trileset
+
+
+# stages faster than this are dominated by timer noise
+# and never reported as a regression
+NOISE_FLOOR = 0.001
+
+
+class Stages:
+    timings: dict[str, float]
+
+
+    def __init__(self) -> None:
+        self.timings = {}
+
+
+    def run(self, name: str, function: Callable, *args) -> Any:
+        start = time.perf_counter()
+        value = function(*args)
+        self.timings[name] = time.perf_counter() - start
+        return value
+
+
+def bench_trileset(folder: Path, options: dict[str, Any]) -> dict[str, float]:
+    xml_path = folder / 'trile sets' / 'synthetic.xml'
+    if not xml_path.exists():
+        xml_path.parent.mkdir(parents=True, exist_ok=True)
+        generate_trileset(xml_path, options['triles'], options['subdivisions'])
+        generate_texture(xml_path.with_suffix('.png'))
+
+    output_format = options['output_format']
+    gltf_path = xml_path.with_suffix(OUTPUT_FORMATS[output_format])
+    stages = Stages()
+
+    raw = stages.run('read', read_xml_file, xml_path)
+    trileset = stages.run('parse', convert_trileset.parse_trile_from_xml, raw)
+    stages.run('optimize', lambda: [optimize_geometry(x) for x in trileset.triles])
+    gltf = stages.run('convert', convert_trileset.convert_trileset_to_gltf, trileset, False)
+    stages.run('build', convert_trileset.save_to_gltf_file, gltf, xml_path.with_suffix('.png'), gltf_path, trileset.meta, output_format)
+    stages.run('render', convert_trileset.generate_mesh_library_tscn, trileset, xml_path.with_suffix('.tscn'), gltf_path.suffix)
+
+    return stages.timings
+
+
+def bench_art_object(folder: Path, options: dict[str, Any]) -> dict[str, float]:
+    xml_path = folder / 'art objects' / 'syntheticao.xml'
+    if not xml_path.exists():
+        xml_path.parent.mkdir(parents=True, exist_ok=True)
+        generate_art_object(xml_path, options['art_object_subdivisions'])
+        generate_texture(xml_path.parent / 'synthetic.png')
+
+    output_format = options['output_format']
+    texture_path = xml_path.parent / 'synthetic.png'
+    stages = Stages()
+
+    raw = stages.run('read', read_xml_file, xml_path)
+    art_object = stages.run('parse', convert_art_object.parse_art_object_from_xml, raw)
+    stages.run('optimize', optimize_geometry, art_object)
+    lods = stages.run('lods', generate_lods, art_object, options['lods'])[1:]
+    gltf = stages.run('convert', convert_art_object.convert_art_object_to_gltf, art_object, texture_path, False, False, lods)
+    stages.run('build', convert_art_object.save_to_gltf_file, gltf, texture_path, xml_path.with_suffix(OUTPUT_FORMATS[output_format]), output_format)
+
+    return stages.timings
+
+
+def bench_animation(folder: Path, options: dict[str, Any], pc: bool = True) -> dict[str, float]:
+    xml_path = folder / 'character animations' / ('synthetic' if pc else 'synthetic_xbox') / 'Synthetic.xml'
+    if not xml_path.exists():
+        xml_path.parent.mkdir(parents=True, exist_ok=True)
+        generate_animation(xml_path, options['frames'], pc)
+
+    tres_path = xml_path.with_suffix('.tres')
+    stages = Stages()
+
+    raw = stages.run('read', read_xml_file, xml_path)
+    anim = stages.run('parse', convert_animation.parse_anim_from_xml, raw)
+    text = stages.run('render', convert_animation.convert_anim_to_sprite_frames, [(tres_path, anim)])
+    stages.run('write', convert_animation.save_to_tres_file, text, tres_path)
+
+    return stages.timings
+
+
+def bench_animation_xbox(folder: Path, options: dict[str, Any]) -> dict[str, float]:
+    # xbox frames carry no rectangles, they are stacked in one column
+    return bench_animation(folder, options, False)
+
+
+def bench_text(folder: Path, options: dict[str, Any]) -> dict[str, float]:
+    xml_path = folder / 'resources' / 'synthetic.xml'
+    if not xml_path.exists():
+        xml_path.parent.mkdir(parents=True, exist_ok=True)
+        generate_text(xml_path, options['entries'])
+
+    stages = Stages()
+
+    raw = stages.run('read', read_xml_file, xml_path)
+    entries = stages.run('parse', convert_text.parse_text_from_xml, raw)
+    stages.run('render', lambda: [
+        convert_text.convert_text_to_po(k, v, xml_path.with_suffix(f'.{k}.po')) for k, v in entries.items()
+    ])
+
+    return stages.timings
+
+
+def bench_spatial_index(folder: Path, options: dict[str, Any]) -> dict[str, float]:
+    xml_path = folder / 'levels' / 'synthetic.xml'
+    trileset_path = folder / 'levels' / 'synthetic_triles.xml'
+    if not xml_path.exists():
+        xml_path.parent.mkdir(parents=True, exist_ok=True)
+        generate_trileset(trileset_path, 16)
+        generate_level(xml_path, trileset_path.stem, options['cells'], 16)
+
+    trileset = convert_trileset.parse_trile_from_xml(read_xml_file(trileset_path))
+    index_path = xml_path.with_suffix('.kspi')
+    stages = Stages()
+
+    raw = stages.run('read', read_xml_file, xml_path)
+    level = stages.run('parse', convert_level.parse_level_from_xml, raw)
+    items = convert_level.map_triles_to_items(level, trileset)
+    records, tables = stages.run('build', convert_level.create_spatial_records, level, items, trileset)
+    stages.run('write', write_spatial_index, index_path, records, tables)
+
+    # the same cells every run, some of them past the level
+    rng = random.Random(0)
+    low, high = level.position.min(axis=0).tolist(), level.position.max(axis=0).tolist()
+    cells = [
+        tuple(rng.randint(a, b + (b - a) // 3) for a, b in zip(low, high))
+        for _ in range(options['queries'])
+    ]
+
+    with stages.run('open', SpatialIndex, index_path) as index:
+        stages.run('lookup', lambda: [index.lookup(*x) for x in cells])
+        stages.run('below', lambda: [index.below(x, high[1] + 1, z) for x, _, z in cells])
+
+    return stages.timings
+
+
+BENCHMARKS = {
+    'trileset': bench_trileset,
+    'art_object': bench_art_object,
+    'animation': bench_animation,
+    'animation_xbox': bench_animation_xbox,
+    'text': bench_text,
+    'spatial_index': bench_spatial_index,
+}
+
+
+def run_benchmarks(names: list[str], repeat: int, options: dict[str, Any]) -> dict[str, dict[str, float]]:
+    results = {}
+
+    with tempfile.TemporaryDirectory(prefix='kompass-benchmark-') as folder:
+        for name in names:
+            logging.info('running %s', name)
+
+            # the best of several runs is the least disturbed by the rest of
+            # the system, the first run also pays for the imports and templates
+            best: dict[str, float] = {}
+            for _ in range(repeat):
+                for stage, seconds in BENCHMARKS[name](Path(folder), options).items():
+                    best[stage] = min(seconds, best.get(stage, seconds))
+
+            best['total'] = sum(best.values())
+            results[name] = best
+
+    return results
+
+
+def compare_results(results: dict, baseline: dict, threshold: float) -> list[str]:
+    regressions = []
+
+    for name, stages in results.items():
+        for stage, seconds in stages.items():
+            previous = baseline.get(name, {}).get(stage)
+            if previous is None:
+                print(f'  {name:14} {stage:10} {seconds * 1000:10.2f} ms')
+                continue
+
+            ratio = seconds / previous if previous else 1.0
+            marker = ''
+            if ratio > 1.0 + threshold and seconds - previous > NOISE_FLOOR:
+                marker = '  REGRESSION'
+                regressions.append(f'{name}/{stage}')
+
+            print(f'  {name:14} {stage:10} {seconds * 1000:10.2f} ms {previous * 1000:10.2f} ms {ratio:6.2f}x{marker}')
+
+    return regressions
+
+
+@click.command()
+@click.option('--only', '-o', 'names', multiple=True, type=click.Choice(list(BENCHMARKS)), help='Run only the given benchmarks')
+@click.option('--triles', default=500, help='Number of triles in the synthetic trile set')
+@click.option('--subdivisions', default=1, help='Quads per trile face edge')
+@click.option('--art-object-subdivisions', default=32, help='Quads per art object face edge')
+@click.option('--lods', default=2, help='Number of simplified levels of detail of the art object')
+@click.option('--frames', default=200, help='Number of frames in the synthetic animation')
+@click.option('--entries', default=1000, help='Number of text entries per locale')
+@click.option('--cells', default=50000, help='Number of trile instances in the synthetic level')
+@click.option('--queries', default=10000, help='Number of spatial index queries of every kind')
+@click.option('--format', '-f', 'output_format', type=click.Choice(list(OUTPUT_FORMATS)), default='gltf+datauri', help='Layout of the built meshes')
+@click.option('--repeat', '-r', default=3, help='Number of runs, the fastest one is reported')
+@click.option('--save', '-s', type=click.Path(dir_okay=False), help='Write the results as JSON')
+@click.option('--baseline', '-b', type=click.Path(exists=True, dir_okay=False), help='Compare against previously saved results')
+@click.option('--threshold', '-t', default=0.1, help='Slowdown relative to the baseline reported as a regression')
+def main(names: tuple[str], repeat: int, save: str, baseline: str, threshold: float, **options):
+    results = run_benchmarks(list(names or BENCHMARKS), max(repeat, 1), options)
+
+    previous = {}
+    if baseline:
+        with open(baseline, 'rt', encoding='utf-8') as file:
+            previous = json.load(file)['results']
+
+    regressions = compare_results(results, previous, threshold)
+
+    if save:
+        data = {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'options': options,
+            'results': results,
+        }
+        with open(save, 'wt', encoding='utf-8') as file:
+            json.dump(data, file, indent=1)
+
+    if regressions:
+        print(f'{len(regressions)} stages are slower than the baseline: {", ".join(regressions)}', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='[%(levelname)s] %(message)s',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S')
+
+    main()
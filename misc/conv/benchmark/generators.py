@@ -0,0 +1,170 @@
+import random
+
+from pathlib import Path
+from PIL import Image
+
+
+# corners of the six cube faces in the order of common.NORMALS
+CUBE_FACES = [
+    [(-1, -1, -1), (-1, -1, 1), (-1, 1, 1), (-1, 1, -1)],
+    [(-1, -1, -1), (1, -1, -1), (1, -1, 1), (-1, -1, 1)],
+    [(-1, -1, -1), (-1, 1, -1), (1, 1, -1), (1, -1, -1)],
+    [(1, -1, -1), (1, 1, -1), (1, 1, 1), (1, -1, 1)],
+    [(-1, 1, -1), (-1, 1, 1), (1, 1, 1), (1, 1, -1)],
+    [(-1, -1, 1), (1, -1, 1), (1, 1, 1), (-1, 1, 1)],
+]
+
+FACE_KEYS = ['Back', 'Front', 'Left', 'Right', 'Top', 'Down']
+
+LOCALES = ['', 'de', 'es', 'fr', 'it', 'ja', 'ko', 'pt', 'zh']
+
+
+def _vertex(position: tuple, normal: int, texcoord: tuple) -> str:
+    x, y, z = position
+    u, v = texcoord
+    return (
+        '<VertexPositionNormalTextureInstance>'
+        f'<Position><Vector3 x="{x:g}" y="{y:g}" z="{z:g}" /></Position>'
+        f'<Normal>{normal}</Normal>'
+        f'<TextureCoord><Vector2 x="{u:.6f}" y="{v:.6f}" /></TextureCoord>'
+        '</VertexPositionNormalTextureInstance>'
+    )
+
+
+def generate_geometry(subdivisions: int, atlas: tuple[float, float], rng: random.Random) -> str:
+    # a cube of half size 0.5 with every face split into a grid of quads,
+    # positions are jittered a little so that meshes differ between triles
+    vertices = []
+    indices = []
+    step = 1.0 / subdivisions
+    jitter = rng.uniform(0.0, 0.01)
+
+    for normal, (a, b, c, d) in enumerate(CUBE_FACES):
+        for j in range(subdivisions):
+            for i in range(subdivisions):
+                base = len(vertices)
+                for s, t in ((i, j), (i + 1, j), (i + 1, j + 1), (i, j + 1)):
+                    u, v = s * step, t * step
+                    position = tuple(
+                        0.5 * ((1 - u) * (1 - v) * a[k] + u * (1 - v) * b[k] + u * v * c[k] + (1 - u) * v * d[k]) + jitter
+                        for k in range(3)
+                    )
+                    texcoord = (atlas[0] + (normal + u) / 48.0, atlas[1] + v / 8.0)
+                    vertices.append(_vertex(position, normal, texcoord))
+
+                indices += [base, base + 1, base + 2, base, base + 2, base + 3]
+
+    return (
+        '<ShaderInstancedIndexedPrimitives type="TriangleList">'
+        f'<Vertices>{"".join(vertices)}</Vertices>'
+        f'<Indices>{"".join(f"<Index>{x}</Index>" for x in indices)}</Indices>'
+        '</ShaderInstancedIndexedPrimitives>'
+    )
+
+
+def generate_trileset(path: Path, triles: int, subdivisions: int = 1, seed: int = 0) -> None:
+    rng = random.Random(seed)
+    entries = []
+
+    for key in range(triles):
+        atlas = ((key % 8) / 8.0, (key // 8 % 8) / 8.0)
+        faces = ''.join(
+            f'<Face key="{x}"><CollisionType>{rng.choice(["None", "AllSides", "TopOnly"])}</CollisionType></Face>'
+            for x in FACE_KEYS
+        )
+
+        entries.append(
+            f'<TrileEntry key="{key}">'
+            f'<Trile name="Trile {key}" cubemapPath="" immaterial="False" seeThrough="False" '
+            f'thin="False" forceHugging="False" surfaceType="{rng.choice(["Grass", "Metal", "Stone", "Wood"])}">'
+            '<ActorSettings type="None" face="Front" />'
+            f'<Faces>{faces}</Faces>'
+            f'<Geometry>{generate_geometry(subdivisions, atlas, rng)}</Geometry>'
+            '<Size><Vector3 x="1" y="1" z="1" /></Size>'
+            f'<AtlasOffset><Vector2 x="{atlas[0]:g}" y="{atlas[1]:g}" /></AtlasOffset>'
+            '</Trile>'
+            '</TrileEntry>'
+        )
+
+    path.write_text(
+        f'<TrileSet name="{path.stem}"><Triles>{"".join(entries)}</Triles></TrileSet>',
+        encoding='utf-8'
+    )
+
+
+def generate_level(path: Path, trileset: str, cells: int, triles: int, seed: int = 0) -> None:
+    # columns of triles over a square sized for the requested number of cells
+    rng = random.Random(seed)
+    side = max(int((cells / 4) ** 0.5), 1)
+    entries = []
+    column = 0
+
+    while len(entries) < cells:
+        x, z = column % side, column // side
+        column += 1
+        height = rng.randint(1, 7)
+        for y in range(min(height, cells - len(entries))):
+            entries.append(
+                '<Entry>'
+                f'<TrileEmplacement x="{x}" y="{y}" z="{z}" />'
+                f'<TrileInstance trileId="{rng.randrange(triles)}" orientation="{rng.randrange(4)}">'
+                f'<Position><Vector3 x="{x}" y="{y}" z="{z}" /></Position>'
+                '</TrileInstance>'
+                '</Entry>'
+            )
+
+    path.write_text(
+        f'<Level name="{path.stem}" trileSetName="{trileset}"><Triles>{"".join(entries)}</Triles></Level>',
+        encoding='utf-8'
+    )
+
+
+def generate_art_object(path: Path, subdivisions: int = 16, seed: int = 0) -> None:
+    rng = random.Random(seed)
+
+    path.write_text(
+        f'<ArtObject name="{path.stem}" cubemapPath="{path.stem}" actorType="None" noSihouette="False">'
+        '<Size><Vector3 x="1" y="1" z="1" /></Size>'
+        f'{generate_geometry(subdivisions, (0.0, 0.0), rng)}'
+        '</ArtObject>',
+        encoding='utf-8'
+    )
+
+
+def generate_animation(path: Path, frames: int, pc: bool = True, size: int = 32) -> None:
+    if pc:
+        entries = ''.join(
+            f'<FramePC duration="1000000"><Rectangle x="{x * size}" y="0" w="{size}" h="{size}" /></FramePC>'
+            for x in range(frames)
+        )
+        tag = 'AnimatedTexturePC'
+    else:
+        entries = '<Frame duration="1000000" />' * frames
+        tag = 'AnimatedTexture'
+
+    path.write_text(
+        f'<{tag} width="{size}" height="{size}" actualWidth="{size - 2}" actualHeight="{size}">'
+        f'<Frames>{entries}</Frames>'
+        f'</{tag}>',
+        encoding='utf-8'
+    )
+
+
+def generate_texture(path: Path, width: int = 1, height: int = 1) -> None:
+    # an opaque white image
+    Image.new('RGBA', (width, height), (255, 255, 255, 255)).save(path)
+
+
+def generate_text(path: Path, entries: int, locales: list[str] = LOCALES) -> None:
+    dictionaries = []
+
+    for locale in locales:
+        messages = ''.join(
+            f'<Entry key="MESSAGE_{x}">Message {x} of {locale or "en"}'
+            + ('&#xD;\nsecond line' if x % 5 == 0 else '')
+            + '</Entry>'
+            for x in range(entries)
+        )
+        dictionaries.append(f'<Entry key="{locale}"><Dict>{messages}</Dict></Entry>')
+
+    path.write_text(f'<Dict>{"".join(dictionaries)}</Dict>', encoding='utf-8')
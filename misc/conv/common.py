@@ -1,14 +1,18 @@
+import hashlib
+import io
 import json
+import mako.lookup
+import mako.template
 import mmh3
-import time
-import random
+import numpy as np
+import os
 import wordsegment
-import xmltodict
 
 from dataclasses import dataclass, field
 from pathlib import Path
 from types import SimpleNamespace
-from typing import Self
+from typing import Any, BinaryIO, Callable, Iterator, Self
+from xml.etree.ElementTree import Element, iterparse
 
 
 @dataclass
@@ -62,21 +66,6 @@ class Quaternion:
         )
 
 
-@dataclass
-class Face:
-    a: int = 0
-    b: int = 0
-    c: int = 0
-
-    @staticmethod
-    def parse(chunk: list[str]):
-        return Face(
-            a=int(chunk[0]),
-            b=int(chunk[1]),
-            c=int(chunk[2]),
-        )
-
-
 @dataclass
 class Rect2:
     x: int = 0
@@ -100,67 +89,236 @@ class Rect2:
 @dataclass
 class Geometry:
     name: str = ''
-    vertex: list[Vector3] = field(default_factory=list)
-    normal: list[Vector3] = field(default_factory=list)
-    texture: list[Vector2] = field(default_factory=list)
-    index: list[Face] = field(default_factory=list)
+    vertex: np.ndarray = field(default_factory=lambda: np.empty((0, 3), dtype=np.float32))
+    normal: np.ndarray = field(default_factory=lambda: np.empty((0, 3), dtype=np.float32))
+    texture: np.ndarray = field(default_factory=lambda: np.empty((0, 2), dtype=np.float32))
+    index: np.ndarray = field(default_factory=lambda: np.empty((0, 3), dtype=np.uint32))
 
 
-NORMALS = [
-    Vector3(-1, 0, 0),
-    Vector3(0, -1, 0),
-    Vector3(0, 0, -1),
-    Vector3(1, 0, 0),
-    Vector3(0, 1, 0),
-    Vector3(0, 0, 1)
-]
+NORMALS = np.array([
+    (-1, 0, 0),
+    (0, -1, 0),
+    (0, 0, -1),
+    (1, 0, 0),
+    (0, 1, 0),
+    (0, 0, 1)
+], dtype=np.float32)
 
 WORDSEGMENT_LOADED = False
 
+SCENE_ID_ALPHABET = 'abcdefghijklmnopqrstuvwxyz0123456789'
+SCENE_ID_LENGTH = 5
+
+TEMPLATES_PATH = Path(__file__).parent / 'templates'
+CACHE_PATH = Path(__file__).parent / '.cache'
+
+TEMPLATE_LOOKUP: mako.lookup.TemplateLookup = None
+
+SNAKE_CASE_PATH = CACHE_PATH / 'snake_case.json'
+SNAKE_CASE_CACHE: dict[str, str] = None
+
+# inputs already read by the caller, e.g. by the reader stage of the
+# convert_assets pipeline, are parsed from memory instead of the disk
+PREFETCHED_INPUTS: dict[str, bytes] = {}
+
+# while set, outputs are handed to it instead of being written here,
+# e.g. to the writer stage of the convert_assets pipeline
+OUTPUT_WRITER: Callable[[Path, str | bytes], None] | None = None
+
+
+def decode_geometry(element: Element) -> Geometry:
+    geometry = Geometry()
+
+    vertices = element.find('Vertices')
+    if vertices is not None:
+        positions = [float(x.get(k)) for x in vertices.iter('Vector3') for k in 'xyz']
+        texcoords = [float(x.get(k)) for x in vertices.iter('Vector2') for k in 'xy']
+        normals = [int(x.text) for x in vertices.iter('Normal')]
+
+        geometry.vertex = np.array(positions, dtype=np.float32).reshape(-1, 3)
+        geometry.texture = np.array(texcoords, dtype=np.float32).reshape(-1, 2)
+        geometry.normal = NORMALS[np.array(normals, dtype=np.intp)]
+
+    indices = element.find('Indices')
+    if indices is not None:
+        indices = [int(x.text) for x in indices.iter('Index')]
+        geometry.index = np.array(indices, dtype=np.uint32).reshape(-1, 3)
+
+    return geometry
+
+
+# elements that are decoded straight into the structures used by the
+# converters instead of the generic namespace layout
+DECODERS = {
+    'ShaderInstancedIndexedPrimitives': decode_geometry,
+}
+
+
+def _walk_xml_file(path: Path, streamed: str | None) -> Iterator[tuple[bool, Any]]:
+    # follows the xmltodict layout: attributes are stored as '@name',
+    # the text of an element with attributes as '#text', elements with
+    # text only become strings and repeated children become lists
+    elements = []
+    children = [{}]
+    decoding = 0
+
+    with open_input(path) as file:
+        for event, element in iterparse(file, events=('start', 'end')):
+            if event == 'start':
+                # the subtree of a decoded element is kept until it ends
+                if decoding or element.tag in DECODERS:
+                    decoding += 1
+                else:
+                    elements.append(element)
+                    children.append({})
+                continue
+
+            if decoding:
+                decoding -= 1
+                if decoding:
+                    continue
+
+                value = DECODERS[element.tag](element)
+            else:
+                elements.pop()
+                members = children.pop()
+                text = element.text.strip() if element.text else None
+
+                if element.attrib or members:
+                    value = SimpleNamespace(**{f'@{k}': v for k, v in element.attrib.items()}, **members)
+                    if text:
+                        setattr(value, '#text', text)
+                else:
+                    value = text or None
+
+            # streamed elements are handed out as soon as they end and are
+            # never attached, so only one of them is alive at a time
+            siblings = children[-1]
+            if element.tag == streamed:
+                yield True, value
+            elif element.tag not in siblings:
+                siblings[element.tag] = value
+            elif type(siblings[element.tag]) is list:
+                siblings[element.tag].append(value)
+            else:
+                siblings[element.tag] = [siblings[element.tag], value]
+
+            # the element is fully converted, so the tree built by iterparse
+            # can release it along with the already visited siblings
+            element.clear()
+            if elements:
+                del elements[-1][:]
+
+    yield False, SimpleNamespace(**children[0])
+
 
 def read_xml_file(path: Path) -> SimpleNamespace:
-    with open(path, 'rt') as file:
-        dictionary = xmltodict.parse(file.read())
-    
-    string = json.dumps(dictionary)
-    xml = json.loads(string, object_hook=lambda x: SimpleNamespace(**x))
+    for _, document in _walk_xml_file(path, None):
+        return document
 
-    return xml
 
+def iterate_xml_file(path: Path, tag: str) -> Iterator[Any]:
+    # elements of the tag one by one, in the layout of read_xml_file
+    for streamed, value in _walk_xml_file(path, tag):
+        if streamed:
+            yield value
 
-def divide_to_chunks(lst: list, size: int):
-    for i in range(0, len(lst), size):
-        yield lst[i:i+size]
 
+def read_xml_attributes(path: Path) -> dict[str, str]:
+    # attributes of the root element, without reading the rest
+    with open_input(path) as file:
+        _, element = next(iterparse(file, events=('start',)))
 
-def read_geometry_from_xml(geometry: Geometry, xml: SimpleNamespace) -> bool:
-    if not hasattr(xml.Vertices, 'VertexPositionNormalTextureInstance'):
-        return False
+    return dict(element.attrib)
+
+
+def open_input(path: Path) -> BinaryIO:
+    data = PREFETCHED_INPUTS.get(str(path))
+    return io.BytesIO(data) if data is not None else open(path, 'rb')
 
-    vertices = xml.Vertices.VertexPositionNormalTextureInstance
-    for vertex in vertices:
-        position = Vector3.parse(vertex.Position.Vector3)
-        geometry.vertex.append(position)
 
-        texture = Vector2.parse(vertex.TextureCoord.Vector2)
-        geometry.texture.append(texture)
+def write_output(path: Path, data: str | bytes | list[memoryview]) -> None:
+    # chunks are joined only when the write is handed over, the
+    # writer may outlive the arrays the chunks are views of
+    if OUTPUT_WRITER:
+        OUTPUT_WRITER(path, data if isinstance(data, (str, bytes)) else b''.join(data))
+    else:
+        save_output(path, data)
 
-        normal_idx = int(vertex.Normal)
-        normal = NORMALS[normal_idx]
-        geometry.normal.append(normal)
 
-    indices = xml.Indices.Index
-    indices = divide_to_chunks(indices, 3)
+def save_output(path: Path, data: str | bytes | list[memoryview]) -> None:
+    if isinstance(data, str):
+        with open(path, 'wt', encoding='utf-8') as file:
+            file.write(data)
+        return
+
+    with open(path, 'wb') as file:
+        file.writelines([data] if isinstance(data, bytes) else data)
+
+
+def hash_geometry(geometry: Geometry) -> bytes:
+    hash = hashlib.blake2b(digest_size=16)
+    for array in (geometry.vertex, geometry.normal, geometry.texture, geometry.index):
+        hash.update(f'{array.dtype}{array.shape}'.encode())
+        hash.update(np.ascontiguousarray(array))
+    return hash.digest()
+
+
+def read_geometry_from_xml(geometry: Geometry, xml: Geometry) -> bool:
+    if not len(xml.vertex):
+        return False
+
+    geometry.vertex = xml.vertex
+    geometry.normal = xml.normal
+    geometry.texture = xml.texture
+    geometry.index = xml.index
 
-    for idx in indices:
-        face = Face.parse(idx)
-        geometry.index.append(face)
-    
     return True
 
 
+def get_template(name: str) -> mako.template.Template:
+    global TEMPLATE_LOOKUP
+    if TEMPLATE_LOOKUP is None:
+        # the lookup keeps compiled templates for the whole process, the
+        # module directory shares them with other processes and runs
+        TEMPLATE_LOOKUP = mako.lookup.TemplateLookup(
+            directories=[str(TEMPLATES_PATH)],
+            module_directory=str(CACHE_PATH / 'templates')
+        )
+
+    return TEMPLATE_LOOKUP.get_template(name)
+
+
+def _read_snake_case_cache() -> dict[str, str]:
+    try:
+        with open(SNAKE_CASE_PATH, 'rt', encoding='utf-8') as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _write_snake_case_cache(cache: dict[str, str]) -> None:
+    # other processes may have added names in the meantime, so the file
+    # is merged before it is atomically replaced
+    cache = _read_snake_case_cache() | cache
+    temporary = SNAKE_CASE_PATH.with_suffix(f'.{os.getpid()}.tmp')
+
+    SNAKE_CASE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with open(temporary, 'wt', encoding='utf-8') as file:
+        json.dump(cache, file, indent=0, sort_keys=True)
+
+    os.replace(temporary, SNAKE_CASE_PATH)
+
+
 def to_snake_case(string: str) -> str:
-    global WORDSEGMENT_LOADED
+    global SNAKE_CASE_CACHE, WORDSEGMENT_LOADED
+    if SNAKE_CASE_CACHE is None:
+        SNAKE_CASE_CACHE = _read_snake_case_cache()
+
+    if string in SNAKE_CASE_CACHE:
+        return SNAKE_CASE_CACHE[string]
+
+    # the corpus takes seconds to load, so it is only touched on a miss
     if not WORDSEGMENT_LOADED:
         wordsegment.load()
         WORDSEGMENT_LOADED = True
@@ -168,28 +326,45 @@ def to_snake_case(string: str) -> str:
     splitted_string = wordsegment.segment(string)
     snake_string = '_'.join(splitted_string).lower()
 
+    SNAKE_CASE_CACHE[string] = snake_string
+    _write_snake_case_cache(SNAKE_CASE_CACHE)
+
     return snake_string
 
 
-def generate_scene_unique_id(prefix: int | str) -> str:
-    timestamp = int(time.time()).to_bytes(4)
-    hash = mmh3.hash(signed=False, key=timestamp)
-    
-    for _ in range(7):
-        number = random.getrandbits(32).to_bytes(4)
-        hash = mmh3.hash(signed=False, seed=hash, key=number)
-
-    characters = 5
-    char_count = ord('z') - ord('a')
-    base = char_count + (ord('9') - ord('0'))
-
-    id = ''
-    for _ in range(characters):
-        c = hash % base
-        if c < char_count:
-            id += chr(ord('a') + c)
-        else:
-            id += chr(ord('0') + (c - char_count))
-        hash //= base
-
-    return f'"{prefix}_{id}"'
\ No newline at end of file
+class SceneIdGenerator:
+    seed: int
+    index: int
+    used: set[str]
+
+
+    def __init__(self: Self, path: Path) -> None:
+        # only the folder and file name take part, so the ids do not
+        # depend on where the assets are unpacked
+        asset = f'{path.parent.name}/{path.name}'
+        self.seed = mmh3.hash(asset, signed=False)
+        self.index = 0
+        self.used = set()
+
+
+    def generate(self: Self, prefix: int | str) -> str:
+        # the n-th id of a file is always derived from the same hash,
+        # collisions within the file skip to the next index
+        while True:
+            hash = mmh3.hash(self.index.to_bytes(4, 'little'), seed=self.seed, signed=False)
+            self.index += 1
+
+            id = ''
+            for _ in range(SCENE_ID_LENGTH):
+                hash, c = divmod(hash, len(SCENE_ID_ALPHABET))
+                id += SCENE_ID_ALPHABET[c]
+
+            if id not in self.used:
+                break
+
+        self.used.add(id)
+        return f'"{prefix}_{id}"'
+
+
+    def generate_many(self: Self, prefix: int | str, count: int) -> list[str]:
+        return [self.generate(prefix) for _ in range(count)]
@@ -1,11 +1,14 @@
 import click
+import json
 import logging
-import mako.template
 
+from collections import Counter
 from math import ceil
 from pathlib import Path
-from common import Rect2, Vector2, read_xml_file, to_snake_case, generate_scene_unique_id
-from dataclasses import asdict, dataclass, field
+from profiling import stage
+from common import Rect2, SceneIdGenerator, Vector2, get_template, to_snake_case, write_output
+from dataclasses import dataclass, field
+from parse_cache import read_parsed
 from types import SimpleNamespace
 
 
@@ -15,28 +18,31 @@ class AnimatedTexturePC:
     actualSize: Vector2 = field(default_factory=Vector2)
     durations: list[float] = field(default_factory=list)
     frames: list[Rect2] = field(default_factory=list)
+    pages: list[int] = field(default_factory=list)
     speed: float = 0.0
 
 
 @dataclass
-class AnimationResource:
+class TextureResource:
     id: str = ''
     name: str = ''
     folder: str = ''
+
+
+@dataclass
+class AnimationResource:
+    name: str = ''
+    textures: list[TextureResource] = field(default_factory=list)
     length: float = 0.0
     times: list[float] = field(default_factory=list)
     transitions: list[float] = field(default_factory=list)
     values: list[Rect2] = field(default_factory=list)
+    texture_times: list[float] = field(default_factory=list)
+    texture_transitions: list[float] = field(default_factory=list)
+    texture_values: list[str] = field(default_factory=list)
     offset: Vector2 = field(default_factory=Vector2)
 
 
-@dataclass
-class TextureResource:
-    id: str = ''
-    name: str = ''
-    folder: str = ''
-
-
 @dataclass
 class AtlasTexture:
     id: str = ''
@@ -112,24 +118,52 @@ def parse_anim_from_xml(xml: SimpleNamespace) -> AnimatedTexturePC:
     return anim_texture
 
 
-def convert_anim_to_sprite_frames(anim_textures: list[tuple[Path, AnimatedTexturePC]]) -> str:
+def read_atlas(atlas_path: Path) -> dict:
+    with open(atlas_path, 'rt', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def apply_atlas(anim_texture: AnimatedTexturePC, atlas: dict, key: str) -> None:
+    frames = atlas['animations'][key]
+    anim_texture.pages = [x[0] for x in frames]
+    anim_texture.frames = [Rect2(*x[1:]) for x in frames]
+
+
+def convert_anim_to_sprite_frames(anim_textures: list[tuple[Path, AnimatedTexturePC]], pages: list[Path] | None = None, names: list[str] | None = None) -> str:
+    pages = pages or []
     textures: list[TextureResource] = []
     atlases: list[AtlasTexture] = []
     animations: list[SpriteFramesAnimation] = []
+    ids = SceneIdGenerator(anim_textures[0][0])
 
-    for i, (path, anim_texture) in enumerate(anim_textures, 1):
+    # pages of a packed atlas are shared by all animations,
+    # otherwise every animation brings its own strip
+    for i, page in enumerate(pages, 1):
         textures.append(TextureResource(
-            id = generate_scene_unique_id(i),
-            name = path.stem,
-            folder = path.parent.stem,
+            id = ids.generate(i),
+            name = page.stem,
+            folder = page.parent.stem,
         ))
 
+    names = names or [path.stem for path, _ in anim_textures]
+
+    for i, ((path, anim_texture), name) in enumerate(zip(anim_textures, names), 1):
+        if not pages:
+            textures.append(TextureResource(
+                id = ids.generate(i),
+                name = path.stem,
+                folder = path.parent.stem,
+            ))
+
         sprites: list[SpriteFrame] = []
 
-        for frame, duration in zip(anim_texture.frames, anim_texture.durations):
+        atlas_ids = ids.generate_many('AtlasTexture', len(anim_texture.frames))
+        texture_ids = [textures[x].id for x in anim_texture.pages] if pages else [textures[-1].id] * len(atlas_ids)
+
+        for id, texture_id, frame, duration in zip(atlas_ids, texture_ids, anim_texture.frames, anim_texture.durations):
             atlases.append(AtlasTexture(
-                id = generate_scene_unique_id('AtlasTexture'),
-                texture = textures[-1].id,
+                id = id,
+                texture = texture_id,
                 region = frame,
             ))
 
@@ -142,12 +176,12 @@ def convert_anim_to_sprite_frames(anim_textures: list[tuple[Path, AnimatedTextur
             frames = sprites,
             loop = True,
             speed = anim_texture.speed,
-            name = path.stem
+            name = name
         ))
 
     steps = len(atlases) + len(textures) + 1
 
-    template = mako.template.Template(filename='templates/sprite_frames.tres')
+    template = get_template('sprite_frames.tres')
     text = template.render(
         steps = steps,
         textures = textures,
@@ -158,14 +192,20 @@ def convert_anim_to_sprite_frames(anim_textures: list[tuple[Path, AnimatedTextur
     return text
 
 
-def convert_anim_to_animations(anim_texture: AnimatedTexturePC, path: Path) -> str:
+def convert_anim_to_animations(anim_texture: AnimatedTexturePC, path: Path, pages: list[Path] | None = None) -> str:
     def concat(lst: list) -> str:
         return ', '.join(map(str, lst))
     
     resource = AnimationResource()
     resource.name = path.stem
-    resource.folder = path.parent.stem
-    resource.id = generate_scene_unique_id(1)
+
+    ids = SceneIdGenerator(path)
+    for i, page in enumerate(pages or [path], 1):
+        resource.textures.append(TextureResource(
+            id = ids.generate(i),
+            name = page.stem,
+            folder = page.parent.stem,
+        ))
 
     resource.values += anim_texture.frames
     for duration in anim_texture.durations:
@@ -173,14 +213,27 @@ def convert_anim_to_animations(anim_texture: AnimatedTexturePC, path: Path) -> s
         resource.times.append(round(resource.length, 2))
         resource.length += duration / 10**7
 
+    # the texture is keyed again only where the frames
+    # move on to another page of the atlas
+    current = None
+    for time, page in zip([0, *resource.times[1:]], anim_texture.pages or [0]):
+        if page != current:
+            resource.texture_times.append(time)
+            resource.texture_transitions.append(1)
+            resource.texture_values.append(f'ExtResource({resource.textures[page].id})')
+            current = page
+
     resource.times = concat(resource.times)
     resource.values = concat(resource.values)
     resource.transitions = concat(resource.transitions)
+    resource.texture_times = concat(resource.texture_times)
+    resource.texture_transitions = concat(resource.texture_transitions)
+    resource.texture_values = concat(resource.texture_values)
     resource.length = '%.3f' % resource.length
     resource.offset = str(Vector2(0, 2))
 
-    template = mako.template.Template(filename='templates/animation.tres')
-    text = template.render(**asdict(resource))
+    template = get_template('animation.tres')
+    text = template.render(**vars(resource))
 
     return text
 
@@ -197,8 +250,7 @@ def rename_anim_texture(texture_path: Path, name: str) -> None:
 
 
 def save_to_tres_file(tres_text: str, tres_path) -> None:
-    with open(tres_path, 'wt', encoding='utf-8') as tres:
-        tres.write(tres_text)
+    write_output(tres_path, tres_text)
 
 
 @click.command()
@@ -206,30 +258,84 @@ def save_to_tres_file(tres_text: str, tres_path) -> None:
 @click.option('--output', '-o', type=click.Choice(['sprite-frames', 'animations']), required=True)
 @click.option('--fps', '-s', default=7.0)
 @click.option('--rename-texture', '-rt', 'rename_texture', is_flag=True)
-def main(xml: str, output: str, fps: float, rename_texture: bool):
+@click.option('--atlas', '-a', type=click.Path(exists=True, dir_okay=False), help='Take frames from a packed atlas instead of the strip')
+@click.option('--character', '-c', is_flag=True, help='XML is a character folder, all its animations go into one sprite frames resource')
+@click.option('--cache/--no-cache', default=True, help='Reuse parsed animations while their XML is unchanged')
+def main(xml: str, output: str, fps: float, rename_texture: bool, atlas: str | None = None, character: bool = False, cache: bool = True):
     xml_path = Path(xml).resolve()
-    texture_path = xml_path.with_suffix('.ani.png')
 
-    logging.info('parsing the %s', xml_path.name)
+    if character:
+        if output != 'sprite-frames':
+            raise click.BadParameter('a character is converted only to sprite frames', param_hint='--output')
+
+        xml_paths = [x for x in sorted(xml_path.glob('**/*.xml')) if x.stem != 'metadata']
+        tres_path = Path(xml_path, to_snake_case(xml_path.name)).with_suffix('.tres')
+    else:
+        xml_paths = [xml_path]
+        tres_path = Path(xml_path.parent, to_snake_case(xml_path.stem)).with_suffix('.tres')
+
+    if not xml_paths:
+        logging.warning('no animations in %s', xml_path.name)
+        return []
+
+    pages = []
+    if atlas:
+        atlas_path = Path(atlas).resolve()
+        logging.info('taking frames from %s', atlas_path.name)
+        atlas_data = read_atlas(atlas_path)
+        pages = [atlas_path.parent / x for x in atlas_data['pages']]
+
+        # the atlas leaves out animations whose strip is missing
+        packed = atlas_data['animations']
+        for path in [x for x in xml_paths if x.relative_to(atlas_path.parent).as_posix() not in packed]:
+            logging.warning('skipping %s, it is not in %s', path.name, atlas_path.name)
+            xml_paths.remove(path)
 
-    raw = read_xml_file(xml_path)
-    anim_data = parse_anim_from_xml(raw)
-    anim_data.speed = fps
+        if not xml_paths:
+            logging.warning('no animations of %s in %s', xml_path.name, atlas_path.name)
+            return []
 
-    converted_name = to_snake_case(xml_path.stem)
-    tres_path = Path(xml_path.parent, converted_name).with_suffix('.tres')
+    anim_textures: list[tuple[Path, AnimatedTexturePC]] = []
+    names: list[str] = []
+
+    # animations of a character sharing a file name in different
+    # subfolders are told apart by the subfolder, e.g. walk_run/run
+    stems = Counter(to_snake_case(x.stem) for x in xml_paths)
+
+    for path in xml_paths:
+        logging.info('parsing the %s', path.name)
+
+        anim_data = read_parsed(path, parse_anim_from_xml, [AnimatedTexturePC, Rect2, Vector2], cache)
+        anim_data.speed = fps
+
+        if atlas:
+            apply_atlas(anim_data, atlas_data, path.relative_to(atlas_path.parent).as_posix())
+
+        # the animation and its renamed strip are named after this path
+        anim_path = Path(path.parent, to_snake_case(path.stem)).with_suffix('.tres')
+        name = anim_path.stem
+        if stems[name] > 1:
+            name = (anim_path.parent.relative_to(xml_path) / name).as_posix()
+
+        names.append(name)
+        anim_textures.append((anim_path, anim_data))
 
     logging.info('converting to %s', tres_path.name)
 
-    match output:
-        case 'sprite-frames':
-            tres_text = convert_anim_to_sprite_frames( [(tres_path, anim_data)] )
-        case 'animations':
-            tres_text = convert_anim_to_animations(anim_data, tres_path)
-    
-    save_to_tres_file(tres_text, tres_path)
+    with stage('render'):
+        match output:
+            case 'sprite-frames':
+                tres_text = convert_anim_to_sprite_frames( anim_textures, pages, names )
+            case 'animations':
+                tres_text = convert_anim_to_animations(anim_textures[0][1], tres_path, pages)
+
+    with stage('write'):
+        save_to_tres_file(tres_text, tres_path)
     if rename_texture:
-        rename_anim_texture(texture_path, converted_name)
+        for path, (anim_path, _) in zip(xml_paths, anim_textures):
+            rename_anim_texture(path.with_suffix('.ani.png'), anim_path.stem)
+
+    return [tres_path]
 
 
 if __name__ == '__main__':
@@ -1,10 +1,18 @@
 import click
 import logging
 
-from common import Geometry, Vector2, Vector3, read_geometry_from_xml, read_xml_file
+from common import Geometry, Vector2, Vector3, read_geometry_from_xml
 from dataclasses import dataclass, field
-from gltf_builder import GltfBuilder
+from gltf_builder import GltfBuilder, OUTPUT_FORMATS
+from mesh_optimizer import compute_acmr, generate_lods, optimize_geometry
+from parse_cache import read_parsed
 from pathlib import Path
+from profiling import stage
+
+
+# the full detail mesh is visible up to this many units per unit of the
+# art object size, every following level doubles the distance
+LOD_DISTANCE = 16.0
 
 
 @dataclass
@@ -23,18 +31,41 @@ def parse_art_object_from_xml(xml: dict) -> ArtObject:
     return art_object
 
 
-def convert_art_object_to_gltf(art_object: ArtObject, texture_path: Path, embed_texture: bool) -> GltfBuilder:
-    return GltfBuilder(art_object.name) \
+def get_visibility_range(art_object: ArtObject, level: int, levels: int) -> dict[str, float]:
+    distance = max(art_object.size.x, art_object.size.y, art_object.size.z) * LOD_DISTANCE
+
+    return {
+        'lod': level,
+        'visibility_range_begin': distance * 2 ** (level - 1) if level > 0 else 0.0,
+        'visibility_range_end': distance * 2 ** level if level < levels - 1 else 0.0,
+    }
+
+
+def convert_art_object_to_gltf(art_object: ArtObject, texture_path: Path, embed_texture: bool, interleaved: bool = False, lods: list[Geometry] | None = None) -> GltfBuilder:
+    builder = GltfBuilder(art_object.name, interleaved) \
         .set_image(texture_path.stem, embed_texture) \
-        .set_material(art_object.name) \
-        .create_mesh(art_object.name, Vector3()) \
-        .set_vertices(art_object.vertex) \
-        .set_normals(art_object.normal) \
-        .set_texcoords(art_object.texture) \
-        .set_indices(art_object.index)
+        .set_material(art_object.name)
+
+    if not lods:
+        return builder.create_mesh(art_object.name, Vector3()) \
+            .set_attributes(art_object.vertex, art_object.normal, art_object.texture) \
+            .set_indices(art_object.index)
+
+    # every level is a sibling node, the extras hold its visibility range,
+    # which res://misc/import/post_import.gd sets on the imported node
+    levels = [art_object, *lods]
+    for level, geometry in enumerate(levels):
+        name = f'{art_object.name}_LOD{level}' if level else art_object.name
+        extras = get_visibility_range(art_object, level, len(levels))
+
+        builder.create_mesh(name, Vector3(), **extras) \
+            .set_attributes(geometry.vertex, geometry.normal, geometry.texture) \
+            .set_indices(geometry.index)
+
+    return builder
 
 
-def save_to_gltf_file(builder: GltfBuilder, texture_path: Path, save_path: Path) -> None:
+def save_to_gltf_file(builder: GltfBuilder, texture_path: Path, save_path: Path, output_format: str = 'gltf+datauri') -> list[Path]:
     import datetime
     
     calendar = datetime.date.today().isocalendar()
@@ -45,28 +76,53 @@ def save_to_gltf_file(builder: GltfBuilder, texture_path: Path, save_path: Path)
     copyright = f'converted by zerocker at {yy}w{ww}{dw}'
     generator = 'kompass'
     
-    builder.set_asset(copyright, generator) \
-        .build(texture_path.parent, save_path)
+    return builder.set_asset(copyright, generator) \
+        .build(texture_path.parent, save_path, output_format)
 
 
 @click.command()
 @click.argument('xml')
 @click.argument('texture')
 @click.option('--embedded', '-e', is_flag=True, help='Embedd *.png image to GLTF file')
-def main(xml: str, texture: str, embedded: bool):
+@click.option('--interleaved', '-i', is_flag=True, help='Store vertex attributes in one interleaved buffer view')
+@click.option('--format', '-f', 'output_format', type=click.Choice(list(OUTPUT_FORMATS)), default='gltf+datauri', help='Layout of the output file and its buffer')
+@click.option('--weld/--no-weld', default=True, help='Merge bit-identical vertices before export')
+@click.option('--reorder', '-r', is_flag=True, help='Reorder triangles and vertices for GPU cache locality')
+@click.option('--lods', '-l', default=0, help='Number of simplified levels of detail to generate')
+@click.option('--cache/--no-cache', default=True, help='Reuse the parsed art object while the XML is unchanged')
+def main(xml: str, texture: str, embedded: bool, interleaved: bool, output_format: str, weld: bool, reorder: bool, lods: int, cache: bool = True):
     xml_path = Path(xml).resolve()
     texture_path = Path(texture).resolve()
-    gltf_path = Path(xml_path).with_suffix('.gltf')
+    gltf_path = Path(xml_path).with_suffix(OUTPUT_FORMATS[output_format])
 
     logging.info('parsing the %s', xml_path.name)
 
-    raw = read_xml_file(xml_path)
-    trileset = parse_art_object_from_xml(raw)
-    
+    art_object = read_parsed(xml_path, parse_art_object_from_xml, [ArtObject, Vector3], cache)
+
+    vertices = len(art_object.vertex)
+    acmr = compute_acmr([art_object]) if reorder else 0.0
+
+    with stage('convert'):
+        optimize_geometry(art_object, weld, reorder)
+
+    logging.info('optimized %d -> %d vertices', vertices, len(art_object.vertex))
+    if reorder:
+        logging.info('reordered for vertex cache, ACMR %.3f -> %.3f', acmr, compute_acmr([art_object]))
+
+    with stage('convert'):
+        levels = generate_lods(art_object, lods)[1:]
+        for geometry in levels:
+            optimize_geometry(geometry, False, reorder)
+
+    for level, geometry in enumerate([art_object, *levels]):
+        logging.info('LOD%d has %d triangles', level, len(geometry.index))
+
     logging.info('converting to %s', gltf_path.name)
 
-    gltf = convert_art_object_to_gltf(trileset, texture_path, embedded)
-    save_to_gltf_file(gltf, texture_path, gltf_path)
+    with stage('convert'):
+        gltf = convert_art_object_to_gltf(art_object, texture_path, embedded, interleaved, levels)
+
+    return save_to_gltf_file(gltf, texture_path, gltf_path, output_format)
 
 
 if __name__ == '__main__':
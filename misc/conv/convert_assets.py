@@ -1,111 +1,695 @@
 import click
+import contextlib
+import csv
+import functools
+import importlib
+import io
+import json
+import logging
+import os
+import signal
+import sys
+import time
+import traceback
 
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from manifest import MANIFEST_NAME, Manifest
 from pathlib import Path
-from convert_animation import main as convert_animation
-from convert_art_object import main as convert_art_object
-from convert_trileset import main as convert_trileset
-from convert_text import main as convert_text
+from pipeline import Pipeline, completed
+from profiling import STAGES, Profile, StageProfile, profile_asset
+from typing import Any, Callable, Iterator
+from xml.etree.ElementTree import iterparse
 
 
-def is_converted(path: Path, suffix: str) -> bool:
-    return path.with_suffix(suffix).exists()
+# converters are imported on first use, so that a run with nothing
+# to convert does not pay for loading numpy, pygltflib and mako
+CONVERTERS = {
+    'animation': 'convert_animation',
+    'art_object': 'convert_art_object',
+    'atlas': 'convert_atlas',
+    'level': 'convert_level',
+    'text': 'convert_text',
+    'trileset': 'convert_trileset',
+}
 
+# bump to force reconversion of every asset after a change to the output
+# that is not caught by the hashes of the converter scripts and templates
+CONVERTER_VERSION = 1
 
-def process_art_objects(root: Path):
+SCRIPTS_PATH = Path(__file__).parent
+
+DEPENDENCIES = {
+    'animation': [
+        'common.py',
+        'convert_animation.py',
+        'parse_cache.py',
+        'templates/animation.tres',
+        'templates/sprite_frames.tres',
+    ],
+    'art_object': [
+        'common.py',
+        'convert_art_object.py',
+        'gltf_builder.py',
+        'mesh_optimizer.py',
+        'parse_cache.py',
+    ],
+    'atlas': [
+        'common.py',
+        'convert_animation.py',
+        'convert_atlas.py',
+        'parse_cache.py',
+    ],
+    'level': [
+        'common.py',
+        'convert_level.py',
+        'convert_trileset.py',
+        'gltf_builder.py',
+        'level_baker.py',
+        'parse_cache.py',
+        'spatial_index.py',
+        'templates/level.tscn',
+        'templates/level_chunk.tscn',
+    ],
+    'text': [
+        'common.py',
+        'convert_text.py',
+        'templates/fez.po',
+    ],
+    'trileset': [
+        'common.py',
+        'convert_trileset.py',
+        'gltf_builder.py',
+        'mesh_optimizer.py',
+        'parse_cache.py',
+        'templates/mesh_library.tscn',
+    ],
+}
+
+# arguments that change how an asset is converted but not the outputs
+RUNTIME_ARGUMENTS = {'cache', 'stream'}
+
+# inputs the reader stage of the pipeline loads for the converters,
+# the other ones are only hashed
+PREFETCHED_SUFFIXES = {'.xml'}
+
+
+@dataclass
+class Task:
+    category: str = ''
+    label: str = ''
+    converter: str = ''
+    source: Path = field(default_factory=Path)
+    inputs: list[Path] = field(default_factory=list)
+    arguments: dict[str, Any] = field(default_factory=dict)
+    digest: str = ''
+
+
+@dataclass
+class Result:
+    task: Task = field(default_factory=Task)
+    outputs: list[Path] = field(default_factory=list)
+    writes: list[tuple[Path, str | bytes]] = field(default_factory=list)
+    log: str = ''
+    error: str = ''
+    profile: Profile | None = None
+
+
+def process_art_objects(root: Path, output_format: str, reorder: bool, lods: int, cache: bool) -> Iterator[Task]:
     art_objects = root / Path('art objects')
     for art_object in art_objects.glob('*.xml'):
-        if is_converted(art_object, '.gltf'):
-            continue
-
-        print(f'[ART OBJECT] {art_object.name}')
-        
         path = str(art_object)
         if 'ao_b.xml' in path:
             path = path.replace('ao_b.xml', '_bao.xml')
 
         # replaces 'ao.xml' suffix with '.png'
         texture = Path(path[:-6]).with_suffix('.png')
-        
-        convert_art_object.callback(
-            xml=art_object,
-            texture=texture,
-            embedded=False
+
+        yield Task(
+            category='ART OBJECT',
+            label=art_object.name,
+            converter='art_object',
+            source=art_object,
+            inputs=[art_object, texture],
+            arguments=dict(
+                xml=art_object,
+                texture=texture,
+                embedded=False,
+                interleaved=False,
+                output_format=output_format,
+                weld=True,
+                reorder=reorder,
+                lods=lods,
+                cache=cache
+            )
         )
 
 
-def process_trilesets(root: Path):
+def process_trilesets(root: Path, output_format: str, reorder: bool, cache: bool, stream: bool) -> Iterator[Task]:
     trilesets = root / Path('trile sets')
     for trileset in trilesets.glob('*.xml'):
-        if is_converted(trileset, '.gltf'):
+        texture = trileset.with_suffix('.png')
+
+        yield Task(
+            category='TRILE SET',
+            label=trileset.name,
+            converter='trileset',
+            source=trileset,
+            inputs=[trileset, texture],
+            arguments=dict(
+                xml=trileset,
+                texture=texture,
+                embedded=False,
+                generate_tscn=True,
+                interleaved=False,
+                output_format=output_format,
+                weld=True,
+                reorder=reorder,
+                cache=cache,
+                stream=stream
+            )
+        )
+
+
+def find_level_trileset(level: Path, trilesets: list[Path]) -> Path | None:
+    # only the root element is read, the trile set is one of its attributes
+    with open(level, 'rb') as file:
+        _, element = next(iterparse(file, events=('start',)))
+
+    name = element.get('trileSetName', '').lower()
+    return next((x for x in trilesets if x.stem.lower() == name), None)
+
+
+def process_levels(root: Path, output_format: str, cache: bool) -> Iterator[Task]:
+    levels = root / Path('levels')
+    trilesets = sorted((root / Path('trile sets')).glob('*.xml'))
+
+    for level in levels.glob('*.xml'):
+        trileset = find_level_trileset(level, trilesets)
+        if trileset is None:
+            print(f'[LEVEL] skipping {level.name}, its trile set is missing', file=sys.stderr)
             continue
 
-        print(f'[TRILE SET] {trileset.name}')
-        
-        texture = trileset.with_suffix('.png')
-        convert_trileset.callback(
-            xml=trileset,
-            texture=texture,
-            embedded=False,
-            generate_tscn=True
+        yield Task(
+            category='LEVEL',
+            label=level.name,
+            converter='level',
+            source=level,
+            inputs=[level, trileset],
+            arguments=dict(
+                xml=level,
+                trileset=trileset,
+                chunk_size=16,
+                bake=True,
+                output_format=output_format,
+                cache=cache
+            )
         )
 
 
-def process_character_animations(root: Path):
+def find_character_animations(character: Path) -> list[Path]:
+    return [x for x in sorted(character.glob('**/*.xml')) if x.stem != 'metadata']
+
+
+def process_character_atlases(root: Path, cache: bool) -> Iterator[Task]:
     character_animations = root / Path('character animations')
     for character in character_animations.iterdir():
-        for animation in character.glob('**/*.xml'):
-            if is_converted(animation, '.tres'):
-                continue
-            
-            if animation.stem == 'metadata':
-                continue
-
-            print(f'[CHARACTER ANIMATION] {animation.parent.name}/{animation.name}')
-            
-            convert_animation.callback(
-                xml=animation,
-                output='animations',
-                fps=7,
-                rename_texture=False
+        animations = find_character_animations(character)
+        if not animations:
+            continue
+
+        # the character folder is the source of its sprite frames
+        # when grouped, the atlas is tracked by its description
+        yield Task(
+            category='CHARACTER ATLAS',
+            label=character.name,
+            converter='atlas',
+            source=character / 'atlas.json',
+            inputs=[x for animation in animations for x in (animation, animation.with_suffix('.ani.png'))],
+            arguments=dict(
+                folder=character,
+                name='atlas',
+                padding=1,
+                max_size=2048,
+                cache=cache
             )
+        )
 
 
-def process_animated_background_planes(root: Path):
+def process_character_animations(root: Path, atlas: bool, group: bool, cache: bool) -> Iterator[Task]:
+    character_animations = root / Path('character animations')
+    for character in character_animations.iterdir():
+        atlas_path = character / 'atlas.json' if atlas else None
+        animations = find_character_animations(character)
+
+        if group and animations:
+            textures = [atlas_path] if atlas else [x.with_suffix('.ani.png') for x in animations]
+
+            yield Task(
+                category='CHARACTER',
+                label=character.name,
+                converter='animation',
+                source=character,
+                inputs=[*animations, *textures],
+                arguments=dict(
+                    xml=character,
+                    output='sprite-frames',
+                    fps=7,
+                    rename_texture=False,
+                    atlas=atlas_path,
+                    character=True,
+                    cache=cache
+                )
+            )
+            continue
+
+        for animation in animations:
+            yield Task(
+                category='CHARACTER ANIMATION',
+                label=f'{animation.parent.name}/{animation.name}',
+                converter='animation',
+                source=animation,
+                inputs=[animation, atlas_path or animation.with_suffix('.ani.png')],
+                arguments=dict(
+                    xml=animation,
+                    output='animations',
+                    fps=7,
+                    rename_texture=False,
+                    atlas=atlas_path,
+                    cache=cache
+                )
+            )
+
+
+def process_animated_background_planes(root: Path, cache: bool) -> Iterator[Task]:
     background_planes = root / Path('background planes')
     for background_plane in background_planes.glob('**/*.xml'):
-        if is_converted(background_plane, '.tres'):
-            continue
-        
-        print(f'[BACKGROUND PLANE] {background_plane.name}')
-
-        convert_animation.callback(
-            xml=background_plane,
-            output='sprite-frames',
-            fps=7,
-            rename_texture=False
+        yield Task(
+            category='BACKGROUND PLANE',
+            label=background_plane.name,
+            converter='animation',
+            source=background_plane,
+            inputs=[background_plane, background_plane.with_suffix('.ani.png')],
+            arguments=dict(
+                xml=background_plane,
+                output='sprite-frames',
+                fps=7,
+                rename_texture=False,
+                cache=cache
+            )
         )
 
 
-def process_resources(root: Path):
+def process_resources(root: Path) -> Iterator[Task]:
     resources = root / Path('resources')
     for resource in resources.glob('*.xml'):
-        if not is_converted(resource, '.po'):
-            print(f'[RESOURCE] {resource.name}')
-            convert_text.callback(xml=resource)
+        yield Task(
+            category='RESOURCE',
+            label=resource.name,
+            converter='text',
+            source=resource,
+            inputs=[resource],
+            arguments=dict(
+                xml=resource
+            )
+        )
+
+
+def run_task(task: Task, profiling: bool = False, dump_folder: Path | None = None, inputs: dict[str, bytes] | None = None, defer: bool = False) -> Result:
+    # collects the log of a single asset, so that parallel workers
+    # do not interleave their messages
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter('    [%(levelname)s] %(funcName)s: %(message)s'))
+
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+
+    dump_path = None
+    if dump_folder:
+        dump_path = dump_folder / f'{task.converter}.{task.label.replace("/", ".")}.prof'
+
+    result = Result(task)
+    common = None
+    try:
+        converter = importlib.import_module(CONVERTERS[task.converter])
+
+        # read ahead inputs are parsed from memory and deferred outputs
+        # are returned with the result for the writer stage
+        common = importlib.import_module('common')
+        common.PREFETCHED_INPUTS = inputs or {}
+        if defer:
+            common.OUTPUT_WRITER = lambda path, data: result.writes.append((path, data))
+
+        with profile_asset(dump_path) if profiling else contextlib.nullcontext() as result.profile:
+            result.outputs = converter.main.callback(**task.arguments)
+    except Exception:
+        result.error = traceback.format_exc()
+    finally:
+        logger.removeHandler(handler)
+        if common:
+            common.PREFETCHED_INPUTS = {}
+            common.OUTPUT_WRITER = None
+
+    result.log = stream.getvalue()
+    return result
+
+
+def is_task_stale(manifest: Manifest, task: Task, force: bool) -> bool:
+    dependencies = [SCRIPTS_PATH / x for x in DEPENDENCIES[task.converter]]
+    options = {k: v for k, v in task.arguments.items() if not isinstance(v, Path) and k not in RUNTIME_ARGUMENTS}
+
+    task.digest = manifest.digest(
+        task.inputs + dependencies,
+        f'version={CONVERTER_VERSION}',
+        f'options={sorted(options.items())}'
+    )
+
+    return force or manifest.is_stale(task.source, task.digest)
+
+
+def find_stale_tasks(manifest: Manifest, tasks: list[Task], force: bool) -> list[Task]:
+    return [x for x in tasks if is_task_stale(manifest, x, force)]
+
+
+def import_converters() -> None:
+    # a warm worker pays for loading numpy, pygltflib and mako
+    # before the first change arrives, not while converting it
+    for name in CONVERTERS.values():
+        importlib.import_module(name)
+
+
+def start_worker() -> None:
+    # Ctrl+C stops the watch in the main process, which then shuts
+    # the pool down, workers would only print their own tracebacks
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import_converters()
+
+
+def run_tasks(manifest: Manifest, tasks: list[Task], force: bool, executor: Executor | None, profiling: bool = False, dump_folder: Path | None = None) -> Iterator[Result]:
+    run = functools.partial(run_task, profiling=profiling, dump_folder=dump_folder)
+    stale = find_stale_tasks(manifest, tasks, force)
+
+    if executor is None:
+        yield from map(run, stale)
+        return
+
+    yield from executor.map(run, stale)
+
+
+def read_task(manifest: Manifest, force: bool, task: Task) -> tuple[Task, dict[str, bytes]] | None:
+    # the reader stage stamps the inputs of the phase while the main thread
+    # records the outputs of finished tasks, tasks of a phase never read
+    # outputs of each other, so the two touch different manifest keys
+    if not is_task_stale(manifest, task, force):
+        return None
+
+    inputs = {
+        str(x): x.read_bytes()
+        for x in task.inputs
+        if x.suffix in PREFETCHED_SUFFIXES and x.is_file()
+    }
+    return task, inputs
+
+
+def convert_task(executor: Executor | None, profiling: bool, dump_folder: Path | None, job: tuple[Task, dict[str, bytes]]) -> Future:
+    task, inputs = job
+    run = functools.partial(run_task, profiling=profiling, dump_folder=dump_folder, inputs=inputs, defer=True)
+
+    if executor is None:
+        return completed(run(task))
+
+    return executor.submit(run, task)
+
+
+def write_result(result: Result) -> Result:
+    common = importlib.import_module('common')
+
+    try:
+        for path, data in result.writes:
+            common.save_output(path, data)
+    except OSError:
+        result.error += traceback.format_exc()
+
+    result.writes = []
+    return result
+
+
+def run_pipelined(manifest: Manifest, tasks: list[Task], force: bool, executor: Executor | None, jobs: int, queue_size: int, writers: int, profiling: bool = False, dump_folder: Path | None = None) -> Iterator[Result]:
+    pipeline = Pipeline(
+        read=functools.partial(read_task, manifest, force),
+        convert=functools.partial(convert_task, executor, profiling, dump_folder),
+        write=write_result,
+        size=queue_size,
+        workers=jobs if executor else 1,
+        writers=writers
+    )
+
+    yield from pipeline.run(tasks)
+
+    occupancy = pipeline.occupancy()
+    if not any(x.items for x in occupancy.values()):
+        return
+
+    for name, stats in occupancy.items():
+        print(f'[PIPELINE] {name} queue: {stats.mean:.2f} of {stats.size} on average, {stats.peak} at most, {stats.items} items')
+
+    # the stage behind the fullest queue holds the others back
+    name, stats = max(occupancy.items(), key=lambda x: x[1].mean / x[1].size)
+    print(f'[PIPELINE] {name} stage is the bottleneck')
+
+
+def write_profile_report(results: list[Result], path: Path, top: int) -> None:
+    results = sorted(results, key=lambda x: x.profile.seconds, reverse=True)
+    rows = []
+
+    for result in results[:top or None]:
+        row = dict(
+            category=result.task.category,
+            label=result.task.label,
+            seconds=round(result.profile.seconds, 6),
+            peak=result.profile.peak
+        )
+        for name in STAGES:
+            stage = result.profile.stages.get(name, StageProfile())
+            row[f'{name}_seconds'] = round(stage.seconds, 6)
+            row[f'{name}_peak'] = stage.peak
+        rows.append(row)
+
+    if path.suffix == '.csv':
+        with open(path, 'wt', encoding='utf-8', newline='') as file:
+            writer = csv.DictWriter(file, ['category', 'label', 'seconds', 'peak', *(f'{x}_{y}' for x in STAGES for y in ('seconds', 'peak'))])
+            writer.writeheader()
+            writer.writerows(rows)
+        return
+
+    # totals of every stage over all assets, not only the slowest ones
+    stages = {}
+    for name in STAGES:
+        profiles = [x.profile.stages[name] for x in results if name in x.profile.stages]
+        stages[name] = dict(
+            seconds=round(sum(x.seconds for x in profiles), 6),
+            peak=max((x.peak for x in profiles), default=0)
+        )
+
+    data = {
+        'assets': len(results),
+        'seconds': round(sum(x.profile.seconds for x in results), 6),
+        'stages': stages,
+        'slowest': rows,
+    }
+
+    with open(path, 'wt', encoding='utf-8') as file:
+        json.dump(data, file, indent=1)
+
+
+def print_result(result: Result) -> None:
+    print(f'[{result.task.category}] {result.task.label}')
+
+    if result.log:
+        print(result.log, end='')
+
+    if result.error:
+        print(result.error, end='', file=sys.stderr)
+
+
+def take_snapshot(root: Path) -> dict[str, tuple[int, int]]:
+    snapshot = {}
+    folders = [root]
+
+    while folders:
+        with os.scandir(folders.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    folders.append(Path(entry.path))
+                elif entry.name != MANIFEST_NAME:
+                    stat = entry.stat()
+                    snapshot[entry.path] = (stat.st_mtime_ns, stat.st_size)
+
+    return snapshot
+
+
+def wait_for_changes(root: Path, snapshot: dict[str, tuple[int, int]], interval: float, debounce: float) -> tuple[dict[str, tuple[int, int]], list[Path]]:
+    while True:
+        time.sleep(interval)
+        current = take_snapshot(root)
+        if current == snapshot:
+            continue
+
+        # editors and exporters save in bursts, the conversion
+        # starts once nothing has changed for the debounce time
+        while True:
+            time.sleep(debounce)
+            settled = take_snapshot(root)
+            if settled == current:
+                break
+            current = settled
+
+        changed = [Path(x) for x in current.keys() | snapshot.keys() if current.get(x) != snapshot.get(x)]
+        return current, changed
+
+
+def collect_phases(root: Path, output_format: str, reorder: bool, lods: int, atlas: bool, group: bool, cache: bool, stream: bool) -> list[list[Task]]:
+    # tasks of a phase read the outputs of the previous phases,
+    # so their staleness is known only after those have finished
+    return [
+        [
+            *(process_character_atlases(root, cache) if atlas else []),
+        ],
+        [
+            *process_art_objects(root, output_format, reorder, lods, cache),
+            *process_trilesets(root, output_format, reorder, cache, stream),
+            *process_levels(root, output_format, cache),
+            *process_character_animations(root, atlas, group, cache),
+            *process_animated_background_planes(root, cache),
+            *process_resources(root),
+        ],
+    ]
+
+
+def convert_phases(manifest: Manifest, phases: list[list[Task]], force: bool, run: Callable[[Manifest, list[Task], bool], Iterator[Result]]) -> tuple[list[Task], list[Result]]:
+    tasks: list[Task] = []
+    results: list[Result] = []
+
+    sources = {manifest.key(x.source) for phase in phases for x in phase}
+    for path in manifest.prune(sources):
+        print(f'[PRUNED] {path.relative_to(manifest.root)}')
+
+    try:
+        for phase in phases:
+            for result in run(manifest, phase, force):
+                tasks.append(result.task)
+                print_result(result)
+                results.append(result)
+                if result.error:
+                    continue
+
+                for path in manifest.update(result.task.source, result.task.digest, result.outputs):
+                    print(f'[PRUNED] {path.relative_to(manifest.root)}')
+    finally:
+        manifest.save()
+
+    return tasks, results
+
+
+def report_results(tasks: list[Task], results: list[Result], profile: str | None, top: int) -> bool:
+    if profile:
+        profiled = [x for x in results if x.profile]
+        write_profile_report(profiled, Path(profile), top)
+        print(f'[PROFILE] {len(profiled)} assets written to {profile}')
+
+    failures = [x for x in results if x.error]
+    if failures:
+        print(f'{len(failures)} of {len(tasks)} assets failed:', file=sys.stderr)
+        for result in failures:
+            print(f'  [{result.task.category}] {result.task.label}', file=sys.stderr)
+
+    return not failures
 
 
 @click.command()
 @click.argument('assets')
-def main(assets: str):
+@click.option('--jobs', '-j', default=1, help='Number of worker processes, 0 uses all cores')
+@click.option('--force', '-f', is_flag=True, help='Reconvert every asset regardless of the manifest')
+@click.option('--format', 'output_format', type=click.Choice(['gltf+datauri', 'gltf+bin', 'glb']), default='gltf+datauri', help='Layout of converted meshes')
+@click.option('--reorder', '-r', is_flag=True, help='Reorder meshes for GPU cache locality')
+@click.option('--lods', '-l', default=0, help='Number of simplified levels of detail for art objects')
+@click.option('--atlas', '-a', is_flag=True, help='Pack the frames of every character into shared atlases')
+@click.option('--group', '-g', is_flag=True, help='Convert every character into one sprite frames resource')
+@click.option('--profile', '-p', type=click.Path(dir_okay=False), help='Write time and memory of every stage to a JSON or CSV report')
+@click.option('--top', default=20, help='Number of the slowest assets in the profile report, 0 keeps all')
+@click.option('--cprofile', type=click.Path(file_okay=False), help='Dump cProfile statistics of every asset to a folder')
+@click.option('--cache/--no-cache', default=True, help='Reuse parsed assets while their XML is unchanged')
+@click.option('--stream', '-s', is_flag=True, help='Write trile set buffers while parsing to bound memory use')
+@click.option('--pipeline', '-P', is_flag=True, help='Overlap reading, converting and writing of assets in a pipeline')
+@click.option('--queue-size', default=8, help='Number of assets waiting between two stages of the pipeline')
+@click.option('--writers', default=2, help='Number of writer threads of the pipeline')
+@click.option('--watch', '-w', is_flag=True, help='Keep running and reconvert assets whenever their files change')
+@click.option('--interval', default=0.25, help='Seconds between two scans of the assets in watch mode')
+@click.option('--debounce', default=0.2, help='Seconds without changes before a reconversion starts in watch mode')
+def main(assets: str, jobs: int, force: bool, output_format: str, reorder: bool, lods: int, atlas: bool, group: bool, profile: str, top: int, cprofile: str, cache: bool, stream: bool, pipeline: bool, queue_size: int, writers: int, watch: bool, interval: float, debounce: float):
     root = Path(assets).resolve()
     assert root.is_dir, f"The '{root}' is not a folder"
 
-    process_art_objects(root)
-    process_trilesets(root)
-    process_character_animations(root)
-    process_animated_background_planes(root)
-    process_resources(root)
+    manifest = Manifest(root)
+    jobs = jobs or os.cpu_count()
+
+    dump_folder = None
+    if cprofile:
+        dump_folder = Path(cprofile).resolve()
+        dump_folder.mkdir(parents=True, exist_ok=True)
+
+    with contextlib.ExitStack() as stack:
+        executor = None
+        if jobs > 1:
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=jobs, initializer=start_worker if watch else None))
+        elif watch:
+            import_converters()
+
+        if pipeline:
+            run = functools.partial(run_pipelined, executor=executor, jobs=jobs, queue_size=queue_size, writers=writers, profiling=bool(profile or cprofile), dump_folder=dump_folder)
+        else:
+            run = functools.partial(run_tasks, executor=executor, profiling=bool(profile or cprofile), dump_folder=dump_folder)
+
+        phases = collect_phases(root, output_format, reorder, lods, atlas, group, cache, stream)
+        tasks, results = convert_phases(manifest, phases, force, run)
+        succeeded = report_results(tasks, results, profile, top)
+
+        if not watch:
+            sys.exit(0 if succeeded else 1)
+
+        # workers are started on demand, a round of empty
+        # tasks starts all of them before the first change
+        if executor:
+            list(executor.map(int, range(jobs)))
+
+        print(f'[WATCH] waiting for changes in {root}, press Ctrl+C to stop')
+        snapshot = take_snapshot(root)
+
+        try:
+            while True:
+                snapshot, changed = wait_for_changes(root, snapshot, interval, debounce)
+                start = time.perf_counter()
+
+                # only the changed files are stat'ed and hashed again
+                manifest.checked.difference_update(manifest.key(x) for x in changed)
+
+                phases = collect_phases(root, output_format, reorder, lods, atlas, group, cache, stream)
+                tasks, results = convert_phases(manifest, phases, False, run)
+                report_results(tasks, results, profile, top)
+
+                # outputs written by the conversion are not changes to react to,
+                # anything else saved meanwhile is picked up by the next scan
+                written = {str(x) for result in results for x in result.outputs}
+                current = take_snapshot(root)
+                snapshot = {k: v for k, v in snapshot.items() if k not in written}
+                snapshot.update((k, current[k]) for k in written if k in current)
+                if tasks:
+                    print(f'[WATCH] {len(tasks)} assets converted in {time.perf_counter() - start:.2f}s')
+        except KeyboardInterrupt:
+            print('[WATCH] stopped')
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,240 @@
+import click
+import hashlib
+import io
+import json
+import logging
+
+from common import Rect2, Vector2, write_output
+from convert_animation import AnimatedTexturePC, parse_anim_from_xml
+from dataclasses import astuple, dataclass, field
+from parse_cache import read_parsed
+from pathlib import Path
+from PIL import Image
+from profiling import stage
+from typing import Self
+
+
+# atlas sizes are rounded up to this, so that block
+# compressed formats do not need to pad them again
+PAGE_ALIGNMENT = 4
+
+
+@dataclass
+class Placement:
+    page: int = 0
+    region: Rect2 = field(default_factory=Rect2)
+
+
+class Skyline:
+    width: int
+    height: int
+    used: tuple[int, int]
+    segments: list[list[int]]
+
+
+    def __init__(self: Self, width: int, height: int) -> None:
+        self.width = width
+        self.height = height
+        self.used = (0, 0)
+        self.segments = [[0, 0, width]]
+
+
+    def fit(self: Self, index: int, width: int, height: int) -> int:
+        # the lowest y a rectangle starting at the segment can rest on
+        x = self.segments[index][0]
+        if x + width > self.width:
+            return -1
+
+        y = 0
+        remaining = width
+        while remaining > 0:
+            _, top, length = self.segments[index]
+            y = max(y, top)
+            if y + height > self.height:
+                return -1
+
+            remaining -= length
+            index += 1
+
+        return y
+
+
+    def insert(self: Self, width: int, height: int) -> tuple[int, int] | None:
+        # bottom-left rule, the placement with the lowest top edge wins
+        best = None
+        for index, (x, _, _) in enumerate(self.segments):
+            y = self.fit(index, width, height)
+            if y >= 0 and (best is None or (y + height, x) < best[:2]):
+                best = (y + height, x, index, y)
+
+        if best is None:
+            return None
+
+        _, x, index, y = best
+        self.segments.insert(index, [x, y + height, width])
+
+        # segments now covered by the new one are cut or removed
+        end = x + width
+        while index + 1 < len(self.segments) and self.segments[index + 1][0] < end:
+            segment = self.segments[index + 1]
+            if segment[0] + segment[2] <= end:
+                del self.segments[index + 1]
+                continue
+
+            segment[2] -= end - segment[0]
+            segment[0] = end
+            break
+
+        merged = [self.segments[0]]
+        for segment in self.segments[1:]:
+            if segment[1] == merged[-1][1]:
+                merged[-1][2] += segment[2]
+            else:
+                merged.append(segment)
+        self.segments = merged
+
+        self.used = (max(self.used[0], end), max(self.used[1], y + height))
+        return x, y
+
+
+def pack_frames(sizes: list[tuple[int, int]], max_size: int, padding: int) -> tuple[list[Placement], list[tuple[int, int]]]:
+    pages: list[Skyline] = []
+    placements = [Placement() for _ in sizes]
+
+    # tall frames first leave the flattest skyline behind
+    order = sorted(range(len(sizes)), key=lambda x: (sizes[x][1], sizes[x][0]), reverse=True)
+
+    for frame in order:
+        width, height = sizes[frame]
+        if width + 2 * padding > max_size or height + 2 * padding > max_size:
+            raise ValueError(f'Frame of {width}x{height} does not fit into an atlas of {max_size}x{max_size}')
+
+        for page, skyline in enumerate(pages):
+            position = skyline.insert(width + 2 * padding, height + 2 * padding)
+            if position:
+                break
+        else:
+            page = len(pages)
+            pages.append(Skyline(max_size, max_size))
+            position = pages[-1].insert(width + 2 * padding, height + 2 * padding)
+
+        x, y = position
+        placements[frame] = Placement(page, Rect2(x + padding, y + padding, width, height))
+
+    page_sizes = [
+        tuple(-(-x // PAGE_ALIGNMENT) * PAGE_ALIGNMENT for x in skyline.used)
+        for skyline in pages
+    ]
+
+    return placements, page_sizes
+
+
+def collect_frames(folder: Path, cache: bool = True) -> tuple[dict[str, list[int]], list[Image.Image], int]:
+    # every distinct frame image is stored once, animations
+    # refer to them by their index in the returned list
+    animations: dict[str, list[int]] = {}
+    frames: list[Image.Image] = []
+    known: dict[bytes, int] = {}
+    memory = 0
+
+    for xml_path in sorted(folder.glob('**/*.xml')):
+        if xml_path.stem == 'metadata':
+            continue
+
+        texture_path = xml_path.with_suffix('.ani.png')
+        if not texture_path.exists():
+            logging.warning('skipping %s, %s is missing', xml_path.name, texture_path.name)
+            continue
+
+        anim = read_parsed(xml_path, parse_anim_from_xml, [AnimatedTexturePC, Rect2, Vector2], cache)
+
+        with stage('read'):
+            strip = Image.open(texture_path).convert('RGBA')
+
+        memory += strip.width * strip.height * 4
+        indices = []
+
+        for region in anim.frames:
+            image = strip.crop((region.x, region.y, region.x + region.w, region.y + region.h))
+            key = hashlib.blake2b(f'{image.size}'.encode() + image.tobytes(), digest_size=16).digest()
+
+            if key not in known:
+                known[key] = len(frames)
+                frames.append(image)
+            indices.append(known[key])
+
+        animations[xml_path.relative_to(folder).as_posix()] = indices
+
+    return animations, frames, memory
+
+
+def save_atlas(atlas_path: Path, animations: dict[str, list[int]], frames: list[Image.Image], placements: list[Placement], page_sizes: list[tuple[int, int]]) -> list[Path]:
+    page_paths = [atlas_path.with_name(f'{atlas_path.stem}_{x}.png') for x in range(len(page_sizes))]
+    pages = [Image.new('RGBA', x, (0, 0, 0, 0)) for x in page_sizes]
+
+    with stage('render'):
+        for image, placement in zip(frames, placements):
+            pages[placement.page].paste(image, (placement.region.x, placement.region.y))
+
+    atlas = {
+        'pages': [x.name for x in page_paths],
+        'animations': {
+            key: [[placements[x].page, *astuple(placements[x].region)] for x in indices]
+            for key, indices in animations.items()
+        },
+    }
+
+    # pages are encoded in memory so that they are written like any
+    # other output, by the writer stage when the conversion is pipelined
+    encoded = []
+    with stage('build'):
+        for page in pages:
+            buffer = io.BytesIO()
+            page.save(buffer, 'PNG', optimize=True)
+            encoded.append(buffer.getvalue())
+
+    with stage('write'):
+        for data, path in zip(encoded, page_paths):
+            write_output(path, data)
+
+        write_output(atlas_path, json.dumps(atlas, indent=1))
+
+    return [*page_paths, atlas_path]
+
+
+@click.command()
+@click.argument('folder')
+@click.option('--name', '-n', default='atlas', help='Name of the atlas description and pages in the folder')
+@click.option('--padding', '-p', default=1, help='Transparent pixels around every frame')
+@click.option('--max-size', '-m', 'max_size', default=2048, help='Largest width and height of an atlas page')
+@click.option('--cache/--no-cache', default=True, help='Reuse parsed animations while their XML is unchanged')
+def main(folder: str, name: str, padding: int, max_size: int, cache: bool = True):
+    folder_path = Path(folder).resolve()
+    atlas_path = folder_path / f'{name}.json'
+
+    logging.info('collecting frames of %s', folder_path.name)
+    animations, frames, memory = collect_frames(folder_path, cache)
+
+    if not frames:
+        logging.warning('no animations with textures in %s', folder_path.name)
+        return []
+
+    with stage('convert'):
+        placements, page_sizes = pack_frames([x.size for x in frames], max_size, padding)
+
+    packed = sum(w * h * 4 for w, h in page_sizes)
+    logging.info('%d frames, %d unique, packed into %d pages',
+        sum(len(x) for x in animations.values()), len(frames), len(page_sizes))
+    logging.info('texture memory %d KiB -> %d KiB, saved %d KiB',
+        memory // 1024, packed // 1024, (memory - packed) // 1024)
+
+    return save_atlas(atlas_path, animations, frames, placements, page_sizes)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='[%(levelname)s] %(funcName)s: %(message)s',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S')
+
+    main()
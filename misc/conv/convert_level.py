@@ -0,0 +1,392 @@
+import click
+import logging
+import numpy as np
+import warnings
+
+from common import NORMALS, SceneIdGenerator, Vector2, Vector3, get_template, write_output
+from convert_trileset import Trile, TrileSet, parse_trile_from_xml, save_to_gltf_file
+from dataclasses import dataclass, field
+from gltf_builder import GltfBuilder, OUTPUT_FORMATS
+from level_baker import LevelBaker, LevelMesh, rotate_y
+from parse_cache import read_parsed
+from pathlib import Path
+from profiling import stage
+from spatial_index import FACES, FLAG_HAS_MESH, FLAG_IMMATERIAL, FLAG_SEE_THROUGH, RECORD, pack_keys, write_spatial_index
+
+
+# godot orthogonal basis indices of the four rotations
+# around the up axis a trile instance can have in FEZ
+ORIENTATIONS = np.array([0, 16, 10, 22], dtype=np.int32)
+
+# grid map cells store every coordinate as a signed 16 bit integer
+CELL_LIMITS = (-32768, 32767)
+
+# the cell word of a grid map is item:16 | rot:5 | layer:8
+ITEM_LIMIT = 2**16
+ROTATION_SHIFT = 16
+
+# the four views of FEZ by the side of the triles they look at,
+# each one only ever sees that side of the visible instances
+VIEWS = {
+    'front': 5,
+    'right': 3,
+    'back': 2,
+    'left': 0,
+}
+
+# edge length of the octants a grid map draws its cells in
+GRID_MAP_OCTANT_SIZE = 8
+
+
+@dataclass
+class Level:
+    name: str = ''
+    trileset: str = ''
+    size: Vector3 = field(default_factory=Vector3)
+    position: np.ndarray = field(default_factory=lambda: np.empty((0, 3), dtype=np.int32))
+    trile: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int32))
+    orientation: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int32))
+
+
+@dataclass
+class LevelChunk:
+    name: str = ''
+    coords: str = ''
+    cells: str = ''
+    mesh: str = ''
+    views: list[str] = field(default_factory=list)
+    visibility: dict[str, str] = field(default_factory=dict)
+
+
+def parse_level_from_xml(xml: dict) -> Level:
+    level = Level()
+    level.name = getattr(xml.Level, '@name')
+    level.trileset = getattr(xml.Level, '@trileSetName')
+
+    if getattr(xml.Level, 'Size', None):
+        level.size = Vector3.parse(xml.Level.Size.Vector3)
+
+    entries = []
+    if xml.Level.Triles:
+        entries = xml.Level.Triles.Entry
+        if type(entries) is not list:
+            entries = [entries]
+
+    position = []
+    trile = []
+    orientation = []
+
+    for entry in entries:
+        emplacement = entry.TrileEmplacement
+        position.append([int(getattr(emplacement, f'@{x}')) for x in 'xyz'])
+        trile.append(int(getattr(entry.TrileInstance, '@trileId')))
+        orientation.append(int(getattr(entry.TrileInstance, '@orientation', 0)))
+
+    level.position = np.array(position, dtype=np.int32).reshape(-1, 3)
+    level.trile = np.array(trile, dtype=np.int32)
+    level.orientation = np.array(orientation, dtype=np.int32)
+
+    return level
+
+
+def map_triles_to_items(level: Level, trileset: TrileSet) -> np.ndarray:
+    # grid map items are the meshes of the library in the order
+    # of the trile set, unknown ids are left out as -1
+    lookup = {trile.id: index for index, trile in enumerate(trileset.triles)}
+    return np.array([lookup.get(x, -1) for x in level.trile.tolist()], dtype=np.int32)
+
+
+def encode_cells(position: np.ndarray, item: np.ndarray, orientation: np.ndarray) -> np.ndarray:
+    # three words per cell: x and y, z, then the item with its orientation
+    if item.size and item.max() >= ITEM_LIMIT:
+        raise ValueError(f'Item {item.max()} does not fit into the cells of a grid map')
+
+    x, y, z = (position[:, i].astype(np.int64) & 0xFFFF for i in range(3))
+
+    cells = np.empty((len(position), 3), dtype=np.int64)
+    cells[:, 0] = x | (y << 16)
+    cells[:, 1] = z
+    cells[:, 2] = item | (ORIENTATIONS[orientation % 4].astype(np.int64) << ROTATION_SHIFT)
+
+    return cells.astype(np.uint32).view(np.int32).ravel()
+
+
+def split_into_chunks(level: Level, chunk_size: int) -> list[tuple[tuple[int, int, int], np.ndarray]]:
+    coords = np.floor_divide(level.position, chunk_size)
+    unique, inverse = np.unique(coords, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.searchsorted(inverse[order], np.arange(len(unique) + 1))
+
+    return [
+        (tuple(unique[i].tolist()), order[bounds[i]:bounds[i + 1]])
+        for i in range(len(unique))
+    ]
+
+
+def encode_visibility(position: np.ndarray, visible: np.ndarray, coords: tuple[int, int, int], chunk_size: int) -> str:
+    # one bit per cell of the chunk volume, x runs fastest, then y and z,
+    # so the game looks up a cell without knowing the order of the cells
+    local = position - np.array(coords) * chunk_size
+    bits = np.zeros(chunk_size ** 3, dtype=bool)
+    bits[(local[:, 0] + chunk_size * (local[:, 1] + chunk_size * local[:, 2]))[visible]] = True
+    return ', '.join(map(str, np.packbits(bits, bitorder='little').tolist()))
+
+
+def create_spatial_records(level: Level, items: np.ndarray, trileset: TrileSet) -> tuple[np.ndarray, dict[str, list[str]]]:
+    triles = trileset.triles
+    surfaces = sorted({x.surface for x in triles})
+    collisions = sorted({'None', *(y for x in triles for y in x.faces.values())})
+
+    flags = np.array([
+        FLAG_IMMATERIAL * x.immaterial | FLAG_SEE_THROUGH * x.see_through | FLAG_HAS_MESH * (len(x.vertex) > 0)
+        for x in triles
+    ], dtype=np.uint8)
+    collision = np.array([
+        [collisions.index(x.faces.get(face, 'None')) for face in FACES]
+        for x in triles
+    ], dtype=np.uint8).reshape(-1, 6)
+    size = np.array([[x.size.x, x.size.y, x.size.z] for x in triles], dtype=np.float32).reshape(-1, 3)
+
+    # collision faces and size turn with the instance, the side of
+    # the level a trile side faces in every orientation is looked up
+    turns = np.array([
+        np.argmax((NORMALS @ rotate_y(x)) @ NORMALS.T, axis=1)
+        for x in range(4)
+    ])
+
+    orientation = level.orientation % 4
+    records = np.zeros(len(items), dtype=RECORD)
+    records['key'] = pack_keys(level.position)
+    records['trile'] = level.trile
+    records['orientation'] = orientation
+    records['surface'] = np.array([surfaces.index(x.surface) for x in triles], dtype=np.uint8)[items]
+    records['flags'] = flags[items]
+    records['collision'] = collision[items[:, None], turns[orientation]]
+    records['size'] = np.where((orientation % 2 == 1)[:, None], size[items][:, [2, 1, 0]], size[items])
+
+    return records, {'surfaces': surfaces, 'collisions': collisions, 'faces': FACES}
+
+
+def count_grid_map_draws(level: Level, items: np.ndarray) -> int:
+    # a grid map draws one multimesh per item used in each of its octants
+    octants = np.floor_divide(level.position, GRID_MAP_OCTANT_SIZE)
+    return len(np.unique(np.column_stack([octants, items]), axis=0))
+
+
+def find_unseen_sides(visible: dict[str, np.ndarray]) -> np.ndarray:
+    # bit n is set when the view looking at side n does not see the instance,
+    # the sides no view looks at are always kept
+    unseen = np.zeros(len(next(iter(visible.values()))), dtype=np.uint8)
+    for view, side in VIEWS.items():
+        unseen |= (~visible[view]).astype(np.uint8) << side
+    return unseen
+
+
+def split_into_views(mesh: LevelMesh) -> dict[str, LevelMesh]:
+    # a view only draws the faces of the side it looks at, the faces no
+    # view looks at straight, like tops and bottoms, go to every view so
+    # that a chunk stays a single draw call
+    shared = ~np.isin(mesh.side, list(VIEWS.values()))
+
+    views = {}
+    for view, side in VIEWS.items():
+        selected = (mesh.side == side) | shared
+        if not selected.any():
+            continue
+
+        corners, index = np.unique(mesh.index[selected], return_inverse=True)
+        views[view] = LevelMesh(
+            vertex=mesh.vertex[corners],
+            normal=mesh.normal[corners],
+            texture=mesh.texture[corners],
+            region=mesh.region[corners],
+            index=index.reshape(-1, 3).astype(np.uint32),
+            side=mesh.side[selected],
+        )
+
+    return views
+
+
+def convert_chunk_to_gltf(views: dict[str, LevelMesh], name: str, trileset_name: str, interleaved: bool = False) -> GltfBuilder:
+    # the texture is shared with the trile set in the meshes folder
+    builder = GltfBuilder(name, interleaved) \
+        .set_image(f'../../meshes/{trileset_name}', False) \
+        .set_material(trileset_name)
+
+    for view, mesh in views.items():
+        builder.create_mesh(view) \
+            .set_attributes(mesh.vertex, mesh.normal, mesh.texture) \
+            .set_texcoords(mesh.region, 1) \
+            .set_indices(mesh.index)
+
+    return builder
+
+
+def generate_chunk_tscn(trileset_name: str, chunk: LevelChunk, region_size: str, path: Path) -> None:
+    ids = SceneIdGenerator(path)
+
+    with stage('render'):
+        template = get_template('level_chunk.tscn')
+        text = template.render(
+            name = chunk.name,
+            folder = path.parent.name,
+            trileset = trileset_name,
+            coords = chunk.coords,
+            cells = chunk.cells,
+            mesh = chunk.mesh,
+            views = chunk.views,
+            visibility = chunk.visibility,
+            region_size = region_size,
+            id = ids.generate(1),
+            mesh_id = ids.generate(2),
+            shader_id = ids.generate(3),
+            texture_id = ids.generate(4),
+            material_id = ids.generate('ShaderMaterial')
+        )
+
+    with stage('write'):
+        write_output(path, text)
+
+
+def generate_level_tscn(level: Level, trileset_name: str, chunks: list[LevelChunk], chunk_size: int, path: Path) -> None:
+    with stage('render'):
+        template = get_template('level.tscn')
+        text = template.render(
+            name = level.name,
+            folder = path.stem,
+            trileset = trileset_name,
+            chunk_size = chunk_size,
+            chunks = chunks
+        )
+
+    with stage('write'):
+        write_output(path, text)
+
+
+@click.command()
+@click.argument('xml')
+@click.argument('trileset')
+@click.option('--chunk-size', '-s', 'chunk_size', default=16, help='Edge length of a streamed chunk in triles')
+@click.option('--bake', '-b', is_flag=True, help='Bake every chunk into one mesh without hidden faces')
+@click.option('--format', '-f', 'output_format', type=click.Choice(list(OUTPUT_FORMATS)), default='gltf+datauri', help='Layout of the baked chunk meshes and their buffer')
+@click.option('--cache/--no-cache', default=True, help='Reuse the parsed level and trile set while their XML is unchanged')
+def main(xml: str, trileset: str, chunk_size: int, bake: bool, output_format: str, cache: bool = True):
+    xml_path = Path(xml).resolve()
+    trileset_path = Path(trileset).resolve()
+    texture_path = trileset_path.with_suffix('.png')
+    tscn_path = xml_path.with_suffix('.tscn')
+    index_path = xml_path.with_suffix('.kspi')
+    chunks_path = xml_path.with_suffix('')
+
+    logging.info('parsing the %s', xml_path.name)
+    level = read_parsed(xml_path, parse_level_from_xml, [Level, Vector3], cache)
+
+    logging.info('parsing the %s', trileset_path.name)
+    triles = read_parsed(trileset_path, parse_trile_from_xml, [TrileSet, Trile, Vector2, Vector3], cache)
+
+    with stage('convert'):
+        items = map_triles_to_items(level, triles)
+
+        unknown = items < 0
+        if unknown.any():
+            logging.warning('skipping %d instances of triles missing in %s', unknown.sum(), trileset_path.name)
+
+        if level.position.size and (level.position.min() < CELL_LIMITS[0] or level.position.max() > CELL_LIMITS[1]):
+            raise ValueError(f'Level {level.name} does not fit into the cells of a grid map')
+
+        kept = ~unknown
+        level.position = level.position[kept]
+        level.trile = level.trile[kept]
+        level.orientation = level.orientation[kept]
+        items = items[kept]
+
+        baker = LevelBaker(triles)
+        visible = {
+            view: baker.find_visible_instances(level.position, items, level.orientation, side)
+            for view, side in VIEWS.items()
+        }
+
+        # sides of instances their view does not see are left out like
+        # the ones covered by a neighbour
+        if bake:
+            hidden = baker.find_hidden_sides(level.position, items, level.orientation) | find_unseen_sides(visible)
+
+        chunks: list[LevelChunk] = []
+        meshes: list[LevelMesh] = []
+        for coords, indices in split_into_chunks(level, chunk_size):
+            cells = encode_cells(level.position[indices], items[indices], level.orientation[indices])
+            chunks.append(LevelChunk(
+                name = 'chunk_%d_%d_%d' % coords,
+                coords = 'Vector3i(%d, %d, %d)' % coords,
+                cells = ', '.join(map(str, cells.tolist())),
+                visibility = {
+                    view: encode_visibility(level.position[indices], bits[indices], coords, chunk_size)
+                    for view, bits in visible.items()
+                },
+            ))
+
+            if bake:
+                meshes.append(baker.bake(level.position[indices], items[indices], level.orientation[indices], hidden[indices]))
+
+    logging.info('%d trile instances in %d chunks of %d', len(items), len(chunks), chunk_size)
+    logging.info('visible instances per view: %s', ', '.join(
+        f'{view} {bits.sum()}' for view, bits in visible.items()))
+
+    chunks_path.mkdir(exist_ok=True)
+    outputs = []
+
+    if bake:
+        with stage('convert'):
+            views = [split_into_views(x) for x in meshes]
+
+        vertices = sum(len(triles.triles[x].vertex) for x in items.tolist())
+        draws = max(sum(view in x for x in views) for view in VIEWS)
+        logging.info('baked %d -> %d vertices, %d -> %d draw calls per view',
+            vertices, sum(len(x.vertex) for x in meshes), count_grid_map_draws(level, items), draws)
+
+        for chunk, mesh in zip(chunks, views):
+            if not mesh:
+                continue
+
+            gltf_path = chunks_path / f'{chunk.name}{OUTPUT_FORMATS[output_format]}'
+            with stage('convert'):
+                gltf = convert_chunk_to_gltf(mesh, chunk.name, trileset_path.stem)
+
+            # the texture is only found next to the trile set in the assets
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', UserWarning)
+                outputs += save_to_gltf_file(gltf, texture_path, gltf_path, {}, output_format)
+            chunk.mesh = gltf_path.suffix
+            chunk.views = list(mesh)
+
+    region_size = 'Vector2(%s, %s)' % (baker.region_size or (1.0, 1.0)) if bake else ''
+
+    for chunk in chunks:
+        chunk_path = chunks_path / f'{chunk.name}.tscn'
+        generate_chunk_tscn(trileset_path.stem, chunk, region_size, chunk_path)
+        outputs.append(chunk_path)
+
+    logging.info('generate spatial index as %s', index_path.name)
+    with stage('build'):
+        records, tables = create_spatial_records(level, items, triles)
+
+    with stage('write'):
+        write_spatial_index(index_path, records, tables)
+    outputs.append(index_path)
+
+    logging.info('generate level scene as %s', tscn_path.name)
+    generate_level_tscn(level, trileset_path.stem, chunks, chunk_size, tscn_path)
+    outputs.append(tscn_path)
+
+    return outputs
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='[%(levelname)s] %(funcName)s: %(message)s',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S')
+
+    main()
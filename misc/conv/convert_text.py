@@ -1,9 +1,9 @@
 import click
 import logging
-import mako.template
 
-from common import read_xml_file
+from common import get_template, read_xml_file, write_output
 from pathlib import Path
+from profiling import stage
 
 
 def parse_text_from_xml(xml: dict) -> dict[str, dict[str, str]]:
@@ -35,11 +35,12 @@ def convert_text_to_po(locale: str, text: dict[str, str], path: Path):
 
         messages[key] = message
     
-    template = mako.template.Template(filename='templates/fez.po')
-    text = template.render(locale=locale, messages=messages)
+    with stage('render'):
+        template = get_template('fez.po')
+        text = template.render(locale=locale, messages=messages)
 
-    with open(path, 'wt', encoding='utf-8') as po:
-        po.write(text)
+    with stage('write'):
+        write_output(path, text)
 
 
 @click.command()
@@ -48,13 +49,21 @@ def main(xml: str):
     xml_path = Path(xml).resolve()
 
     logging.info('parsing the %s', xml_path.name)
-    raw = read_xml_file(xml_path)
-    entries = parse_text_from_xml(raw)
+    with stage('read'):
+        raw = read_xml_file(xml_path)
+
+    with stage('parse'):
+        entries = parse_text_from_xml(raw)
+
+    outputs = []
 
     for locale, entries in entries.items():
         po_path = xml_path.with_suffix(f'.{locale}.po')
         logging.info('converting to %s', po_path.name)
         convert_text_to_po(locale, entries, po_path)
+        outputs.append(po_path)
+
+    return outputs
 
 
 
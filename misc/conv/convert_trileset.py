@@ -1,11 +1,14 @@
 import click
 import logging
-import mako.template
 
-from common import Geometry, Vector2, Vector3, read_geometry_from_xml, read_xml_file, generate_scene_unique_id
+from common import Geometry, SceneIdGenerator, Vector2, Vector3, get_template, hash_geometry, iterate_xml_file, read_geometry_from_xml, read_xml_attributes, write_output
 from dataclasses import dataclass, field, astuple
-from gltf_builder import GltfBuilder
+from gltf_builder import GltfBuilder, OUTPUT_FORMATS
+from mesh_optimizer import compute_acmr, count_cache_misses, optimize_geometry
+from parse_cache import read_parsed
 from pathlib import Path
+from profiling import stage
+from types import SimpleNamespace
 from typing import Any
 
 
@@ -18,6 +21,7 @@ class Trile(Geometry):
     actor: dict[str, str] = field(default_factory=dict)
     surface: str = ''
     immaterial: bool = False
+    see_through: bool = False
     rid: str = ''
 
 
@@ -28,6 +32,46 @@ class TrileSet:
     meta: dict[str, Any] = field(default_factory=dict)
 
 
+def parse_trile_entry(entry: SimpleNamespace) -> tuple[Trile, bool]:
+    trile = Trile()
+    trile.id = int(getattr(entry, '@key'))
+    trile.name = getattr(entry.Trile, '@name')
+    trile.surface = getattr(entry.Trile, '@surfaceType')
+    trile.immaterial = eval(getattr(entry.Trile, '@immaterial'))
+    trile.see_through = eval(getattr(entry.Trile, '@seeThrough', 'False'))
+    trile.actor = {
+        getattr(entry.Trile.ActorSettings, '@type'):
+        getattr(entry.Trile.ActorSettings, '@face')
+    }
+
+    trile.atlas = Vector2.parse(entry.Trile.AtlasOffset.Vector2)
+    trile.size = Vector3.parse(entry.Trile.Size.Vector3)
+
+    primitives = entry.Trile.Geometry.ShaderInstancedIndexedPrimitives
+    has_geometry = read_geometry_from_xml(trile, primitives)
+
+    for face in entry.Trile.Faces.Face:
+        key = getattr(face, '@key')
+        trile.faces[key] = face.CollisionType
+
+    return trile, has_geometry
+
+
+def describe_trile(trile: Trile, index: int, has_geometry: bool) -> dict[str, Any]:
+    return {
+        'meshId': index,
+        'trileId': trile.id,
+        'hasMesh': has_geometry,
+        'surfaceType': trile.surface,
+        'isImmaterial': trile.immaterial,
+        'isSeeThrough': trile.see_through,
+        'actorType': trile.actor,
+        'collisionFaces': trile.faces,
+        'collisionSize': astuple(trile.size),
+        'textureAtlas': astuple(trile.atlas),
+    }
+
+
 def parse_trile_from_xml(xml: dict) -> TrileSet:
     trileset = TrileSet(getattr(xml.TrileSet, '@name'))
 
@@ -35,71 +79,84 @@ def parse_trile_from_xml(xml: dict) -> TrileSet:
         xml.TrileSet.Triles.TrileEntry = [xml.TrileSet.Triles.TrileEntry]
     
     for index, entry in enumerate(xml.TrileSet.Triles.TrileEntry):
-        trile = Trile()
-        trile.id = int(getattr(entry, '@key'))
-        trile.name = getattr(entry.Trile, '@name')
-        trile.surface = getattr(entry.Trile, '@surfaceType')
-        trile.immaterial = eval(getattr(entry.Trile, '@immaterial'))
-        trile.actor = {
-            getattr(entry.Trile.ActorSettings, '@type'):
-            getattr(entry.Trile.ActorSettings, '@face')
-        }
-
-        trile.atlas = Vector2.parse(entry.Trile.AtlasOffset.Vector2)
-        trile.size = Vector3.parse(entry.Trile.Size.Vector3)
-
-        primitives = entry.Trile.Geometry.ShaderInstancedIndexedPrimitives
-        has_geometry = read_geometry_from_xml(trile, primitives)
-        
-        for face in entry.Trile.Faces.Face:
-            key = getattr(face, '@key')
-            trile.faces[key] = face.CollisionType
-
+        trile, has_geometry = parse_trile_entry(entry)
         trileset.triles.append(trile)
-        trileset.meta[trile.name] = {
-            'meshId': index,
-            'trileId': trile.id,
-            'hasMesh': has_geometry,
-            'surfaceType': trile.surface,
-            'isImmaterial': trile.immaterial,
-            'actorType': trile.actor,
-            'collisionFaces': trile.faces,
-            'collisionSize': astuple(trile.size),
-            'textureAtlas': astuple(trile.atlas),
-        }
+        trileset.meta[trile.name] = describe_trile(trile, index, has_geometry)
     
     return trileset
 
 
-def convert_trileset_to_gltf(trileset: TrileSet, embed_texture: bool) -> GltfBuilder:
-    builder = GltfBuilder(trileset.name) \
-        .set_image(trileset.name.lower(), embed_texture) \
-        .set_material(trileset.name)
-    
-    translation = Vector3()
-    count = 0
-
-    for trile in trileset.triles:
-        if not trile.vertex:
-            builder.create_node(trile.name, translation)
-        else:
-            builder.create_mesh(trile.name, translation) \
-                .set_vertices(trile.vertex) \
-                .set_normals(trile.normal) \
-                .set_texcoords(trile.texture) \
-                .set_indices(trile.index) \
-
-        count += 1
-        translation.x += 2
-
-        if (count % 15 == 0):
-            translation.x = 0
-            translation.z -= 2
+def create_trileset_builder(name: str, embed_texture: bool, interleaved: bool = False, stream: Path | None = None) -> GltfBuilder:
+    return GltfBuilder(name, interleaved, stream) \
+        .set_image(name.lower(), embed_texture) \
+        .set_material(name)
+
+
+def add_trile_to_gltf(builder: GltfBuilder, trile: Trile, index: int, meshes: dict[bytes, int]) -> None:
+    # triles are laid out in rows of 15, two units apart
+    translation = Vector3(float(index % 15 * 2), 0.0, float(-(index // 15) * 2))
+
+    # triles with the same geometry share a single mesh
+    if not len(trile.vertex):
+        builder.create_node(trile.name, translation)
+    elif (digest := hash_geometry(trile)) in meshes:
+        builder.create_node(trile.name, translation, meshes[digest])
+    else:
+        meshes[digest] = len(builder.meshes)
+        builder.create_mesh(trile.name, translation) \
+            .set_attributes(trile.vertex, trile.normal, trile.texture) \
+            .set_indices(trile.index)
+
+
+def convert_trileset_to_gltf(trileset: TrileSet, embed_texture: bool, interleaved: bool = False) -> GltfBuilder:
+    builder = create_trileset_builder(trileset.name, embed_texture, interleaved)
+    meshes: dict[bytes, int] = {}
+
+    for index, trile in enumerate(trileset.triles):
+        add_trile_to_gltf(builder, trile, index, meshes)
     
     return builder
 
 
-def save_to_gltf_file(builder: GltfBuilder, texture_path: Path, save_path: Path, meta: dict[str, Any]) -> None:
+def stream_trileset_to_gltf(xml_path: Path, folder: Path, embed_texture: bool, interleaved: bool, weld: bool, reorder: bool) -> tuple[TrileSet, GltfBuilder, dict[str, int]]:
+    # every trile is optimized and written to the buffer file as soon as
+    # its entry is read, only its metadata is kept for the scene and json
+    name = read_xml_attributes(xml_path)['name']
+    trileset = TrileSet(name)
+    builder = create_trileset_builder(name, embed_texture, interleaved, folder)
+    meshes: dict[bytes, int] = {}
+    stats = dict.fromkeys(['vertices', 'optimized', 'triangles', 'misses', 'reordered'], 0)
+
+    try:
+        for index, entry in enumerate(iterate_xml_file(xml_path, 'TrileEntry')):
+            with stage('parse'):
+                trile, has_geometry = parse_trile_entry(entry)
+
+            stats['vertices'] += len(trile.vertex)
+            stats['triangles'] += len(trile.index)
+            if reorder:
+                stats['misses'] += count_cache_misses(trile.index)
+
+            with stage('convert'):
+                optimize_geometry(trile, weld, reorder)
+                add_trile_to_gltf(builder, trile, index, meshes)
+
+            stats['optimized'] += len(trile.vertex)
+            if reorder:
+                stats['reordered'] += count_cache_misses(trile.index)
+
+            empty = Geometry()
+            trile.vertex, trile.normal, trile.texture, trile.index = empty.vertex, empty.normal, empty.texture, empty.index
+            trileset.triles.append(trile)
+            trileset.meta[trile.name] = describe_trile(trile, index, has_geometry)
+    except BaseException:
+        builder.discard()
+        raise
+
+    return trileset, builder, stats
+
+
+def save_to_gltf_file(builder: GltfBuilder, texture_path: Path, save_path: Path, meta: dict[str, Any], output_format: str = 'gltf+datauri') -> list[Path]:
     import datetime
     
     calendar = datetime.date.today().isocalendar()
@@ -110,26 +167,31 @@ def save_to_gltf_file(builder: GltfBuilder, texture_path: Path, save_path: Path,
     copyright = f'converted by zerocker at {yy}w{ww}{dw}'
     generator = 'kompass'
     
-    builder.set_asset(copyright, generator, **meta) \
-        .build(texture_path.parent, save_path)
+    return builder.set_asset(copyright, generator, **meta) \
+        .build(texture_path.parent, save_path, output_format)
 
 
-def generate_mesh_library_tscn(trileset: TrileSet, path: Path) -> None:
-    for trile in trileset.triles:
-        trile.rid = generate_scene_unique_id('BoxShape3D')
-    
-    template = mako.template.Template(filename='templates/mesh_library.tscn')
-    text = template.render(
-        folder = 'meshes',
-        name = path.stem,
-        steps = len(trileset.triles) + 2,
-        triles = trileset.triles,
-        scene_name = trileset.name,
-        id = generate_scene_unique_id(1)
-    )
+def generate_mesh_library_tscn(trileset: TrileSet, path: Path, extension: str = '.gltf') -> None:
+    ids = SceneIdGenerator(path)
+    shape_ids = ids.generate_many('BoxShape3D', len(trileset.triles))
+
+    for trile, id in zip(trileset.triles, shape_ids):
+        trile.rid = id
+
+    with stage('render'):
+        template = get_template('mesh_library.tscn')
+        text = template.render(
+            folder = 'meshes',
+            name = path.stem,
+            extension = extension,
+            steps = len(trileset.triles) + 2,
+            triles = trileset.triles,
+            scene_name = trileset.name,
+            id = ids.generate(1)
+        )
 
-    with open(path, 'wt', encoding='utf-8') as tscn:
-        tscn.write(text)
+    with stage('write'):
+        write_output(path, text)
 
 
 @click.command()
@@ -137,25 +199,57 @@ def generate_mesh_library_tscn(trileset: TrileSet, path: Path) -> None:
 @click.argument('texture')
 @click.option('--embedded', '-e', is_flag=True, help='Embedd *.png image to GLTF file')
 @click.option('--generate-tscn', '-g', 'generate_tscn', is_flag=True, help='Generates mesh library TSCN')
-def main(xml: str, texture: str, embedded: bool, generate_tscn: bool):
+@click.option('--interleaved', '-i', is_flag=True, help='Store vertex attributes in one interleaved buffer view')
+@click.option('--format', '-f', 'output_format', type=click.Choice(list(OUTPUT_FORMATS)), default='gltf+datauri', help='Layout of the output file and its buffer')
+@click.option('--weld/--no-weld', default=True, help='Merge bit-identical vertices before export')
+@click.option('--reorder', '-r', is_flag=True, help='Reorder triangles and vertices for GPU cache locality')
+@click.option('--cache/--no-cache', default=True, help='Reuse the parsed trile set while the XML is unchanged')
+@click.option('--stream', '-s', is_flag=True, help='Write every trile to the buffer as it is parsed to bound memory use')
+def main(xml: str, texture: str, embedded: bool, generate_tscn: bool, interleaved: bool, output_format: str, weld: bool, reorder: bool, cache: bool = True, stream: bool = False):
     xml_path = Path(xml).resolve()
     texture_path = Path(texture).resolve()
-    gltf_path = Path(xml_path).with_suffix('.gltf')
+    gltf_path = Path(xml_path).with_suffix(OUTPUT_FORMATS[output_format])
     tscn_path = Path(xml_path).with_suffix('.tscn')
 
-    logging.info('parsing the %s', xml_path.name)
+    if stream:
+        logging.info('streaming the %s to %s', xml_path.name, gltf_path.name)
 
-    raw = read_xml_file(xml_path)
-    trileset = parse_trile_from_xml(raw)
-    
-    logging.info('converting to %s', gltf_path.name)
+        trileset, gltf, stats = stream_trileset_to_gltf(
+            xml_path, gltf_path.parent, embedded, interleaved, weld, reorder)
+
+        logging.info('optimized %d -> %d vertices', stats['vertices'], stats['optimized'])
+        if reorder and stats['triangles']:
+            logging.info('reordered for vertex cache, ACMR %.3f -> %.3f',
+                stats['misses'] / stats['triangles'], stats['reordered'] / stats['triangles'])
+    else:
+        logging.info('parsing the %s', xml_path.name)
+
+        trileset = read_parsed(xml_path, parse_trile_from_xml, [TrileSet, Trile, Vector2, Vector3], cache)
+
+        vertices = sum(len(x.vertex) for x in trileset.triles)
+        acmr = compute_acmr(trileset.triles) if reorder else 0.0
 
-    gltf = convert_trileset_to_gltf(trileset, embedded)
-    save_to_gltf_file(gltf, texture_path, gltf_path, trileset.meta)
+        with stage('convert'):
+            for trile in trileset.triles:
+                optimize_geometry(trile, weld, reorder)
+
+        logging.info('optimized %d -> %d vertices', vertices, sum(len(x.vertex) for x in trileset.triles))
+        if reorder:
+            logging.info('reordered for vertex cache, ACMR %.3f -> %.3f', acmr, compute_acmr(trileset.triles))
+        logging.info('converting to %s', gltf_path.name)
+
+        with stage('convert'):
+            gltf = convert_trileset_to_gltf(trileset, embedded, interleaved)
+
+    logging.info('%d triles share %d meshes', len(trileset.triles), len(gltf.meshes))
+    outputs = save_to_gltf_file(gltf, texture_path, gltf_path, trileset.meta, output_format)
 
     if generate_tscn:
         logging.info('generate mesh library scene as %s', tscn_path.name)
-        generate_mesh_library_tscn(trileset, tscn_path)
+        generate_mesh_library_tscn(trileset, tscn_path, gltf_path.suffix)
+        outputs.append(tscn_path)
+
+    return outputs
 
 
 if __name__ == '__main__':
@@ -1,38 +1,106 @@
+import base64
 import numpy as np
+import os
 import pygltflib as gltf
+import shutil
+import struct
+import uuid
 
-from common import Face, Vector2, Vector3
+from common import Vector3, write_output
 from dataclasses import astuple
 from pathlib import Path
-from typing import Self
+from profiling import stage
+from typing import BinaryIO, Self
 
 
-def _as_bytes(lst: list, type: str, flat: bool = False) -> bytes:
-    mapped = list(map(astuple, lst))
-    array = np.array(mapped, dtype=type)
-    array = array.flatten() if flat else array
-    return array.tobytes()
+def _as_bytes(array: np.ndarray, type: str) -> memoryview:
+    # a view over the array memory, only converts when the layout differs
+    array = np.ascontiguousarray(array, dtype=type)
+    return memoryview(array).cast('B')
 
 
-def _find_min_max(lst: list, type: str) -> list[float]:
-    if not lst:
+def _index_type(indices: np.ndarray) -> tuple[str, int]:
+    # the smallest component type that can address every vertex
+    highest = int(indices.max()) if indices.size else 0
+    if highest < 2**8:
+        return 'uint8', gltf.UNSIGNED_BYTE
+    if highest < 2**16:
+        return 'uint16', gltf.UNSIGNED_SHORT
+    return 'uint32', gltf.UNSIGNED_INT
+
+
+def _find_min_max(array: np.ndarray) -> list[float]:
+    if not len(array):
         return [0.0, 0.0]
 
-    mapped = list(map(astuple, lst))
-    array = np.array(mapped, dtype=type)
     return [
         array.min(axis=0).tolist(),
         array.max(axis=0).tolist()
     ]
 
 
+def _glb_head_and_tail(json: bytes, length: int) -> tuple[bytes, bytes]:
+    # everything around the chunks of the buffer, which go in between
+    json += b' ' * (-len(json) % 4)
+    padding = -length % 4
+    total = 12 + 8 + len(json) + 8 + length + padding
+
+    head = struct.pack('<4sII', b'glTF', 2, total) \
+        + struct.pack('<I4s', len(json), b'JSON') + json \
+        + struct.pack('<I4s', length + padding, b'BIN\0')
+    return head, bytes(padding)
+
+
+def _write_streamed_glb(path: Path, json: bytes, stream: Path, length: int) -> None:
+    head, tail = _glb_head_and_tail(json, length)
+
+    with open(path, 'wb') as file, open(stream, 'rb') as source:
+        file.write(head)
+        shutil.copyfileobj(source, file, STREAM_BLOCK_SIZE)
+        file.write(tail)
+
+
+def _write_datauri_gltf(path: Path, json: str, stream: Path, marker: str) -> None:
+    # the buffer is encoded block by block in place of the marker,
+    # blocks are a multiple of 3 bytes so no padding appears between them
+    if json.count(marker) != 1:
+        raise ValueError(f'The buffer marker occurs {json.count(marker)} times in the json of {path.name}')
+
+    head, _, tail = json.partition(marker)
+
+    with open(path, 'wt', encoding='utf-8') as file, open(stream, 'rb') as source:
+        file.write(head)
+        while block := source.read(STREAM_BLOCK_SIZE):
+            file.write(base64.b64encode(block).decode('ascii'))
+        file.write(tail)
+
+
+OUTPUT_FORMATS = {
+    'gltf+datauri': '.gltf',
+    'gltf+bin': '.gltf',
+    'glb': '.glb',
+}
+
+# streamed buffers are copied and encoded in blocks of this size
+STREAM_BLOCK_SIZE = 3 * 2**18
+
+INTERLEAVED_LAYOUT = np.dtype([
+    ('position', np.float32, 3),
+    ('normal', np.float32, 3),
+    ('texcoord', np.float32, 2),
+])
+
+
 class GltfBuilder:
     # Common
     name: str
-    binary_blob: bytes
+    chunks: list[memoryview]
     length: int
     buffer: int
     image_format: str
+    interleaved: bool
+    stream: Path | None
+    file: BinaryIO | None
 
     # Scene
     asset: gltf.Asset
@@ -48,13 +116,23 @@ class GltfBuilder:
     texture: gltf.Texture
 
 
-    def __init__(self: Self, name: str) -> None:
+    def __init__(self: Self, name: str, interleaved: bool = False, stream: Path | None = None) -> None:
         self.name = name
-        self.binary_blob = b''
+        self.chunks = []
         self.length = 0
         self.buffer = 0
         self.message = ''
         self.image_format = ''
+        self.interleaved = interleaved
+
+        # a streamed buffer goes to a file of its own in the given folder as
+        # the views are appended, only the accessors and views are kept,
+        # the file is created like any other output so it follows the umask
+        self.stream = None
+        self.file = None
+        if stream:
+            self.stream = stream / f'.{name}.{uuid.uuid4().hex}.tmp'
+            self.file = open(self.stream, 'xb')
 
         self.nodes = []
         self.meshes = []
@@ -67,20 +145,22 @@ class GltfBuilder:
         self.texture = gltf.Texture()
     
 
-    def create_node(self: Self, name: str, translation: Vector3 = Vector3()) -> Self:
+    def create_node(self: Self, name: str, translation: Vector3 = Vector3(), mesh: int = None) -> Self:
         self.nodes.append(gltf.Node(
             name=name,
+            mesh=mesh,
             translation=astuple(translation)
         ))
 
         return self
     
 
-    def create_mesh(self: Self, name: str, translation: Vector3 = Vector3()) -> Self:
+    def create_mesh(self: Self, name: str, translation: Vector3 = Vector3(), **extras) -> Self:
         self.nodes.append(gltf.Node(
             name=name,
             mesh=len(self.meshes),
-            translation=astuple(translation)
+            translation=astuple(translation),
+            extras=extras
         ))
 
         self.meshes.append(gltf.Mesh(
@@ -101,21 +181,84 @@ class GltfBuilder:
         return self
 
 
-    def set_vertices(self: Self, vertices: list[Vector3]) -> Self:
-        assert self.meshes, 'Create the mesh first'
-
-        blob = _as_bytes(vertices, 'float32')
-        min, max = _find_min_max(vertices, 'float32')
+    def _append_view(self: Self, blob: memoryview, stride: int = None, target: int = None) -> int:
+        # chunks are only referenced here and joined once in build() unless
+        # the buffer is streamed, every view starts at a 4-byte boundary as required by accessors
+        padding = -self.length % 4
+        if padding:
+            self._write_chunk(memoryview(bytes(padding)))
+            self.length += padding
 
         self.views.append(gltf.BufferView(
             buffer=self.buffer,
-            byteOffset=len(self.binary_blob),
-            byteLength=len(blob)
+            byteOffset=self.length,
+            byteLength=len(blob),
+            byteStride=stride,
+            target=target
         ))
 
-        view_id = len(self.views) - 1
-        self.binary_blob += blob
+        self._write_chunk(blob)
         self.length += len(blob)
+        return len(self.views) - 1
+
+
+    def _write_chunk(self: Self, blob: memoryview) -> None:
+        if self.file:
+            self.file.write(blob)
+        else:
+            self.chunks.append(blob)
+
+
+    def set_attributes(self: Self, vertices: np.ndarray, normals: np.ndarray, texcoords: np.ndarray) -> Self:
+        if self.interleaved:
+            return self.set_interleaved(vertices, normals, texcoords)
+
+        return self.set_vertices(vertices) \
+            .set_normals(normals) \
+            .set_texcoords(texcoords)
+
+
+    def set_interleaved(self: Self, vertices: np.ndarray, normals: np.ndarray, texcoords: np.ndarray) -> Self:
+        assert self.meshes, 'Create the mesh first'
+
+        array = np.empty(len(vertices), dtype=INTERLEAVED_LAYOUT)
+        array['position'] = vertices
+        array['normal'] = normals
+        array['texcoord'] = texcoords
+
+        min, max = _find_min_max(vertices)
+        view_id = self._append_view(
+            memoryview(array).cast('B'),
+            stride=INTERLEAVED_LAYOUT.itemsize,
+            target=gltf.ARRAY_BUFFER
+        )
+
+        attributes = self.meshes[-1].primitives[0].attributes
+        for name, type in (('position', gltf.VEC3), ('normal', gltf.VEC3), ('texcoord', gltf.VEC2)):
+            self.accessors.append(gltf.Accessor(
+                bufferView=view_id,
+                byteOffset=INTERLEAVED_LAYOUT.fields[name][1],
+                type=type,
+                componentType=gltf.FLOAT,
+                count=len(vertices),
+                min=min if name == 'position' else None,
+                max=max if name == 'position' else None,
+            ))
+
+        accessor_id = len(self.accessors) - 3
+        attributes.POSITION = accessor_id
+        attributes.NORMAL = accessor_id + 1
+        attributes.TEXCOORD_0 = accessor_id + 2
+        return self
+
+
+    def set_vertices(self: Self, vertices: np.ndarray) -> Self:
+        assert self.meshes, 'Create the mesh first'
+
+        blob = _as_bytes(vertices, 'float32')
+        min, max = _find_min_max(vertices)
+
+        view_id = self._append_view(blob)
 
         self.accessors.append(gltf.Accessor(
             bufferView=view_id,
@@ -131,20 +274,12 @@ class GltfBuilder:
         return self
 
 
-    def set_normals(self: Self, normals: list[Vector3]) -> Self:
+    def set_normals(self: Self, normals: np.ndarray) -> Self:
         assert self.meshes, 'Create the mesh first'
         
         blob = _as_bytes(normals, 'float32')
 
-        self.views.append(gltf.BufferView(
-            buffer=self.buffer,
-            byteOffset=len(self.binary_blob),
-            byteLength=len(blob)
-        ))
-
-        view_id = len(self.views) - 1
-        self.binary_blob += blob
-        self.length += len(blob)
+        view_id = self._append_view(blob)
 
         self.accessors.append(gltf.Accessor(
             bufferView=view_id,
@@ -158,20 +293,12 @@ class GltfBuilder:
         return self
     
 
-    def set_texcoords(self: Self, texcoords: list[Vector2]) -> Self:
+    def set_texcoords(self: Self, texcoords: np.ndarray, channel: int = 0) -> Self:
         assert self.meshes, 'Create the mesh first'
         
         blob = _as_bytes(texcoords, 'float32')
 
-        self.views.append(gltf.BufferView(
-            buffer=self.buffer,
-            byteOffset=len(self.binary_blob),
-            byteLength=len(blob)
-        ))
-
-        view_id = len(self.views) - 1
-        self.binary_blob += blob
-        self.length += len(blob)
+        view_id = self._append_view(blob)
 
         self.accessors.append(gltf.Accessor(
             bufferView=view_id,
@@ -181,30 +308,23 @@ class GltfBuilder:
         ))
 
         accessor_id = len(self.accessors) - 1
-        self.meshes[-1].primitives[0].attributes.TEXCOORD_0 = accessor_id
+        setattr(self.meshes[-1].primitives[0].attributes, f'TEXCOORD_{channel}', accessor_id)
         return self
 
 
-    def set_indices(self: Self, indices: list[Face]) -> Self:
+    def set_indices(self: Self, indices: np.ndarray) -> Self:
         assert self.meshes, 'Create the mesh first'
         
-        blob = _as_bytes(indices, 'uint32')
+        type, component_type = _index_type(indices)
+        blob = _as_bytes(indices, type)
 
-        self.views.append(gltf.BufferView(
-            buffer=self.buffer,
-            byteOffset=len(self.binary_blob),
-            byteLength=len(blob)
-        ))
-
-        view_id = len(self.views) - 1
-        self.binary_blob += blob
-        self.length += len(blob)
+        view_id = self._append_view(blob)
 
         self.accessors.append(gltf.Accessor(
             bufferView=view_id,
             type=gltf.SCALAR,
-            componentType=gltf.UNSIGNED_INT,
-            count=len(indices) * 3
+            componentType=component_type,
+            count=indices.size
         ))
 
         accessor_id = len(self.accessors) - 1
@@ -261,7 +381,7 @@ class GltfBuilder:
         return self
 
 
-    def build(self: Self, texture_path: Path, save_path: Path) -> None:
+    def build(self: Self, texture_path: Path, save_path: Path, output_format: str = 'gltf+datauri') -> list[Path]:
         instance = gltf.GLTF2()
         instance.scenes.append(gltf.Scene(name=self.name))
         instance.buffers.append(gltf.Buffer(byteLength=0))
@@ -279,10 +399,90 @@ class GltfBuilder:
         instance.textures.append(self.texture)
         instance.materials.append(self.material)
 
-        instance.set_binary_blob(self.binary_blob)
         instance.buffers[0].byteLength = self.length
-
-        instance.convert_buffers(gltf.BufferFormat.DATAURI)
         instance.convert_images(self.image_format, path=texture_path)
 
-        instance.save(save_path, self.asset)
+        if self.file:
+            self.file.close()
+            return self._build_streamed(instance, save_path, output_format)
+
+        # binary outputs are written straight from the chunks,
+        # only the data uri needs the joined and encoded buffer
+        match output_format:
+            case 'gltf+datauri':
+                with stage('build'):
+                    instance.set_binary_blob(b''.join(self.chunks))
+                    instance.convert_buffers(gltf.BufferFormat.DATAURI)
+
+                with stage('write'):
+                    instance.asset = self.asset
+                    write_output(save_path, instance.gltf_to_json())
+                return [save_path]
+
+            case 'gltf+bin':
+                bin_path = save_path.with_suffix('.bin')
+                instance.buffers[0].uri = bin_path.name
+
+                with stage('write'):
+                    instance.asset = self.asset
+                    write_output(bin_path, self.chunks)
+                    write_output(save_path, instance.gltf_to_json())
+                return [save_path, bin_path]
+
+            case 'glb':
+                with stage('build'):
+                    instance.asset = self.asset
+                    json = instance.gltf_to_json(separators=(',', ':'), indent=None)
+                    head, tail = _glb_head_and_tail(json.encode('utf-8'), self.length)
+
+                with stage('write'):
+                    write_output(save_path, [head, *self.chunks, tail])
+                return [save_path]
+
+        raise ValueError(f'Unknown output format {output_format}')
+
+
+    def _build_streamed(self: Self, instance: gltf.GLTF2, save_path: Path, output_format: str) -> list[Path]:
+        # the buffer is already in the stream file, it becomes the bin file
+        # or is copied block by block into the single file formats
+        instance.asset = self.asset
+
+        try:
+            match output_format:
+                case 'gltf+datauri':
+                    # a fresh marker cannot collide with names or extras
+                    marker = f'buffer-{uuid.uuid4().hex}'
+                    instance.buffers[0].uri = f'{gltf.DATA_URI_HEADER}{marker}'
+
+                    with stage('write'):
+                        _write_datauri_gltf(save_path, instance.gltf_to_json(), self.stream, marker)
+                    return [save_path]
+
+                case 'gltf+bin':
+                    bin_path = save_path.with_suffix('.bin')
+                    instance.buffers[0].uri = bin_path.name
+
+                    with stage('write'):
+                        os.replace(self.stream, bin_path)
+                        write_output(save_path, instance.gltf_to_json())
+                    return [save_path, bin_path]
+
+                case 'glb':
+                    with stage('build'):
+                        json = instance.gltf_to_json(separators=(',', ':'), indent=None)
+
+                    with stage('write'):
+                        _write_streamed_glb(save_path, json.encode('utf-8'), self.stream, self.length)
+                    return [save_path]
+
+            raise ValueError(f'Unknown output format {output_format}')
+        finally:
+            self.discard()
+
+
+    def discard(self: Self) -> None:
+        # removes the stream file unless it was moved in place as the bin file
+        if self.file:
+            self.file.close()
+            if self.stream.exists():
+                os.remove(self.stream)
@@ -0,0 +1,345 @@
+import numpy as np
+
+from collections import Counter
+from common import NORMALS, Geometry
+from convert_trileset import Trile, TrileSet
+from dataclasses import dataclass, field
+from typing import Iterator, Self
+
+
+# trile geometry is authored on a grid far coarser than this,
+# coordinates and areas closer than it are considered equal
+EPSILON = 1e-4
+
+# the two axes spanning a side facing along x, y and z
+SIDE_AXES = [(1, 2), (0, 2), (0, 1)]
+
+# texture coordinates with this region are used as they are,
+# only merged quads repeat their region across several cells
+NO_REGION = (-1.0, -1.0)
+
+# cell coordinates are packed into one integer for the neighbour lookup
+PACK_BITS = 21
+PACK_OFFSET = 1 << (PACK_BITS - 1)
+
+
+@dataclass
+class Quad:
+    region: tuple[float, float, float, float] = (0.0, 0.0, 0.0, 0.0)
+    matrix: tuple[float, float, float, float] = (0.0, 0.0, 0.0, 0.0)
+    offset: np.ndarray = field(default_factory=lambda: np.zeros(2))
+
+
+@dataclass
+class TrileFaces(Geometry):
+    side: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int64))
+    occludes: np.ndarray = field(default_factory=lambda: np.zeros(6, dtype=bool))
+    quads: list[Quad | None] = field(default_factory=lambda: [None] * 6)
+
+
+@dataclass
+class LevelMesh(Geometry):
+    region: np.ndarray = field(default_factory=lambda: np.empty((0, 2), dtype=np.float32))
+    side: np.ndarray = field(default_factory=lambda: np.empty(0, dtype=np.int64))
+
+
+def rotate_y(orientation: int) -> np.ndarray:
+    # the same quarter turns around the up axis as the grid map orientations
+    cos, sin = [(1, 0), (0, 1), (-1, 0), (0, -1)][orientation % 4]
+    return np.array([[cos, 0, sin], [0, 1, 0], [-sin, 0, cos]], dtype=np.float32)
+
+
+def pack_cells(position: np.ndarray) -> np.ndarray:
+    cells = position.astype(np.int64) + PACK_OFFSET
+    return (cells[:, 0] << (2 * PACK_BITS)) | (cells[:, 1] << PACK_BITS) | cells[:, 2]
+
+
+def find_quad(faces: TrileFaces, triangles: np.ndarray, side: int) -> Quad | None:
+    # a side can be merged with its neighbours when it is a single
+    # quad showing one atlas region, rotated or mirrored at most
+    corners = np.unique(triangles)
+    if len(triangles) != 2 or len(corners) != 4:
+        return None
+
+    plane = faces.vertex[corners][:, SIDE_AXES[side % 3]].astype(np.float64)
+    texture = faces.texture[corners].astype(np.float64)
+
+    system = np.column_stack([plane, np.ones(len(plane))])
+    solution = np.linalg.lstsq(system, texture, rcond=None)[0]
+    if np.abs(system @ solution - texture).max() > EPSILON:
+        return None
+
+    low = texture.min(axis=0)
+    size = texture.max(axis=0) - low
+    matrix = solution[:2].T
+
+    # every step along a side axis has to move by a whole region
+    expected = np.diag(size) if abs(matrix[0, 0]) > EPSILON else np.fliplr(np.diag(size))
+    if np.abs(np.abs(matrix) - expected).max() > EPSILON:
+        return None
+
+    return Quad(
+        region=(*low.tolist(), *size.tolist()),
+        matrix=tuple((np.sign(matrix) * expected).ravel().tolist()),
+        offset=solution[2],
+    )
+
+
+def split_trile_faces(trile: Trile, orientation: int, opaque: bool) -> TrileFaces:
+    rotation = rotate_y(orientation)
+    faces = TrileFaces(
+        name=trile.name,
+        vertex=trile.vertex @ rotation.T,
+        normal=trile.normal @ rotation.T,
+        texture=trile.texture,
+        index=trile.index,
+    )
+
+    if not len(faces.index):
+        return faces
+
+    # a triangle lies on a side when all of its corners are on
+    # the boundary plane its normal points out of
+    side = np.argmax(faces.normal[faces.index[:, 0]] @ NORMALS.T, axis=1)
+    corners = faces.vertex[faces.index]
+    depth = corners[np.arange(len(side))[:, None], np.arange(3), (side % 3)[:, None]]
+    boundary = np.where(side < 3, -0.5, 0.5)
+    faces.side = np.where(np.all(np.abs(depth - boundary[:, None]) < EPSILON, axis=1), side, -1)
+
+    area = 0.5 * np.linalg.norm(np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0]), axis=1)
+    for index in range(6):
+        triangles = faces.side == index
+        covered = area[triangles].sum()
+        faces.occludes[index] = opaque and covered > 1.0 - EPSILON
+        faces.quads[index] = find_quad(faces, faces.index[triangles], index) if abs(covered - 1.0) < EPSILON else None
+
+    return faces
+
+
+def merge_cells(cells: set[tuple[int, int]]) -> Iterator[tuple[int, int, int, int]]:
+    # greedy meshing, every rectangle grows along the first axis
+    # as far as it can, then along the second while rows stay full
+    remaining = set(cells)
+    for a, b in sorted(cells, key=lambda x: (x[1], x[0])):
+        if (a, b) not in remaining:
+            continue
+
+        width = 1
+        while (a + width, b) in remaining:
+            width += 1
+
+        height = 1
+        while all((a + x, b + height) in remaining for x in range(width)):
+            height += 1
+
+        for x in range(width):
+            for y in range(height):
+                remaining.discard((a + x, b + y))
+
+        yield a, b, width, height
+
+
+class LevelBaker:
+    trileset: TrileSet
+    region_size: tuple[float, float] | None
+    faces: dict[tuple[int, int], TrileFaces]
+    stripped: dict[tuple[int, int, int], Geometry]
+
+
+    def __init__(self: Self, trileset: TrileSet) -> None:
+        self.trileset = trileset
+        self.faces = {}
+        self.stripped = {}
+
+        # merged quads repeat a region of a single size given to the
+        # level shader, which is the size of almost every trile face
+        sizes = Counter(
+            quad.region[2:]
+            for index in range(len(trileset.triles))
+            for quad in self.get_faces(index, 0).quads
+            if quad
+        )
+        self.region_size = sizes.most_common(1)[0][0] if sizes else None
+
+
+    def get_faces(self: Self, item: int, orientation: int) -> TrileFaces:
+        key = (item, orientation)
+        if key not in self.faces:
+            trile = self.trileset.triles[item]
+            opaque = len(trile.vertex) > 0 and not trile.immaterial and not trile.see_through
+            self.faces[key] = split_trile_faces(trile, orientation, opaque)
+
+        return self.faces[key]
+
+
+    def strip_faces(self: Self, item: int, orientation: int, dropped: int) -> Geometry:
+        # the trile geometry without the triangles on the dropped sides
+        key = (item, orientation, dropped)
+        if key not in self.stripped:
+            faces = self.get_faces(item, orientation)
+            kept = (faces.side < 0) | ((dropped >> np.maximum(faces.side, 0)) & 1 == 0)
+            corners, index = np.unique(faces.index[kept], return_inverse=True)
+
+            self.stripped[key] = Geometry(
+                name=faces.name,
+                vertex=faces.vertex[corners],
+                normal=faces.normal[corners],
+                texture=faces.texture[corners],
+                index=index.reshape(-1, 3).astype(np.uint32),
+            )
+
+        return self.stripped[key]
+
+
+    def find_occluders(self: Self, item: np.ndarray, orientation: np.ndarray) -> np.ndarray:
+        # the opaque and fully covered sides of every instance
+        combos, inverse = np.unique(item * 4 + orientation, return_inverse=True)
+        occludes = np.array([self.get_faces(x // 4, x % 4).occludes for x in combos.tolist()]).reshape(-1, 6)
+        return occludes[inverse.ravel()]
+
+
+    def find_hidden_sides(self: Self, position: np.ndarray, item: np.ndarray, orientation: np.ndarray) -> np.ndarray:
+        # bit n is set when side n touches an opaque side of the neighbour,
+        # neighbours may belong to other chunks so the whole level is given
+        keys = pack_cells(position)
+        order = np.argsort(keys, kind='stable')
+        ordered = keys[order]
+        occludes = self.find_occluders(item, orientation)
+
+        hidden = np.zeros(len(position), dtype=np.uint8)
+        if not len(position):
+            return hidden
+
+        for side, normal in enumerate(NORMALS.astype(np.int64)):
+            neighbour = pack_cells(position + normal)
+            found = np.minimum(np.searchsorted(ordered, neighbour), len(ordered) - 1)
+            covered = (ordered[found] == neighbour) & occludes[order[found], (side + 3) % 6]
+            hidden |= covered.astype(np.uint8) << side
+
+        return hidden
+
+
+    def find_visible_instances(self: Self, position: np.ndarray, item: np.ndarray, orientation: np.ndarray, side: int) -> np.ndarray:
+        # instances seen by an orthographic camera looking at the given side,
+        # every ray through the level ends at the first opaque side facing it
+        if not len(position):
+            return np.zeros(0, dtype=bool)
+
+        axis = side % 3
+        depth = position[:, axis] if side >= 3 else -position[:, axis]
+        lateral = position.copy()
+        lateral[:, axis] = 0
+
+        rays = pack_cells(lateral)
+        order = np.lexsort((-depth, rays))
+        rays = rays[order]
+
+        # occluders passed on the same ray before reaching the instance
+        blocking = self.find_occluders(item, orientation)[order, side].astype(np.int64)
+        passed = np.cumsum(blocking) - blocking
+        starts = np.maximum.accumulate(np.where(np.r_[True, rays[1:] != rays[:-1]], np.arange(len(rays)), 0))
+        passed -= passed[starts]
+
+        drawn = np.array([len(x.vertex) > 0 for x in self.trileset.triles], dtype=bool)
+        visible = np.empty(len(position), dtype=bool)
+        visible[order] = passed == 0
+        return visible & drawn[item]
+
+
+    def bake(self: Self, position: np.ndarray, item: np.ndarray, orientation: np.ndarray, hidden: np.ndarray) -> LevelMesh:
+        vertices: list[np.ndarray] = []
+        normals: list[np.ndarray] = []
+        textures: list[np.ndarray] = []
+        regions: list[np.ndarray] = []
+        indices: list[np.ndarray] = []
+        sides: list[np.ndarray] = []
+        count = 0
+
+        # cells of mergeable sides grouped by side, region and texture
+        # mapping, then by the depth of the plane they lie in
+        planes: dict[tuple, dict[int, set[tuple[int, int]]]] = {}
+        offsets: dict[tuple, np.ndarray] = {}
+
+        combo = (item.astype(np.int64) * 4 + orientation) * 64 + hidden
+        for key in np.unique(combo).tolist():
+            members = combo == key
+            mask = key % 64
+            faces = self.get_faces(key // 256, key // 64 % 4)
+
+            merged = 0
+            for side, quad in enumerate(faces.quads):
+                if quad and quad.region[2:] == self.region_size and not mask >> side & 1:
+                    merged |= 1 << side
+
+            geometry = self.strip_faces(key // 256, key // 64 % 4, mask | merged)
+            cells = position[members]
+
+            if len(geometry.index):
+                size = len(geometry.vertex)
+                vertices.append((geometry.vertex[None] + (cells + 0.5)[:, None]).reshape(-1, 3))
+                normals.append(np.tile(geometry.normal, (len(cells), 1)))
+                textures.append(np.tile(geometry.texture, (len(cells), 1)))
+                regions.append(np.full((len(cells) * size, 2), NO_REGION, dtype=np.float32))
+                indices.append((geometry.index[None] + (count + size * np.arange(len(cells)))[:, None, None]).reshape(-1, 3))
+                sides.append(np.tile(np.argmax(geometry.normal[geometry.index[:, 0]] @ NORMALS.T, axis=1), len(cells)))
+                count += len(cells) * size
+
+            for side in range(6):
+                if not merged >> side & 1:
+                    continue
+
+                quad = faces.quads[side]
+                a, b = SIDE_AXES[side % 3]
+                group = (side, quad.region, quad.matrix)
+
+                # texture coordinates as a function of the plane coordinates
+                # of the level, any cell gives the same after the wrap
+                if group not in offsets:
+                    offsets[group] = quad.offset - np.reshape(quad.matrix, (2, 2)) @ (cells[0, [a, b]] + 0.5)
+
+                depths = planes.setdefault(group, {})
+                for depth, x, y in zip((cells[:, side % 3] + (side >= 3)).tolist(), cells[:, a].tolist(), cells[:, b].tolist()):
+                    depths.setdefault(depth, set()).add((x, y))
+
+        for (side, region, matrix), depths in planes.items():
+            axis = side % 3
+            a, b = SIDE_AXES[axis]
+            flip = np.dot(np.cross(np.eye(3)[a], np.eye(3)[b]), NORMALS[side]) < 0
+            offset = offsets[(side, region, matrix)]
+            matrix = np.reshape(matrix, (2, 2))
+
+            rectangles = np.array([
+                (depth, *rectangle)
+                for depth, cells in depths.items()
+                for rectangle in merge_cells(cells)
+            ], dtype=np.float32).reshape(-1, 5)
+
+            plane = np.empty((len(rectangles), 4, 2), dtype=np.float32)
+            plane[:, :, 0] = rectangles[:, [1]] + [0, 1, 1, 0] * rectangles[:, [3]]
+            plane[:, :, 1] = rectangles[:, [2]] + [0, 0, 1, 1] * rectangles[:, [4]]
+
+            corners = np.empty((len(rectangles), 4, 3), dtype=np.float32)
+            corners[:, :, axis] = rectangles[:, [0]]
+            corners[:, :, a] = plane[:, :, 0]
+            corners[:, :, b] = plane[:, :, 1]
+
+            quads = np.array([[0, 2, 1], [0, 3, 2]] if flip else [[0, 1, 2], [0, 2, 3]])
+            vertices.append(corners.reshape(-1, 3))
+            normals.append(np.tile(NORMALS[side], (len(rectangles) * 4, 1)))
+            textures.append((plane.reshape(-1, 2) @ matrix.T + offset).astype(np.float32))
+            regions.append(np.tile(np.float32(region[:2]), (len(rectangles) * 4, 1)))
+            indices.append((quads[None] + (count + 4 * np.arange(len(rectangles)))[:, None, None]).reshape(-1, 3))
+            sides.append(np.full(len(rectangles) * 2, side))
+            count += len(rectangles) * 4
+
+        if not vertices:
+            return LevelMesh()
+
+        return LevelMesh(
+            vertex=np.concatenate(vertices).astype(np.float32),
+            normal=np.concatenate(normals).astype(np.float32),
+            texture=np.concatenate(textures).astype(np.float32),
+            region=np.concatenate(regions).astype(np.float32),
+            index=np.concatenate(indices).astype(np.uint32),
+            side=np.concatenate(sides).astype(np.int64),
+        )
@@ -0,0 +1,164 @@
+import hashlib
+import json
+import os
+
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Self
+
+
+MANIFEST_NAME = '.kompass-manifest.json'
+MANIFEST_VERSION = 1
+
+
+@dataclass
+class FileStamp:
+    size: int = 0
+    mtime: int = 0
+    digest: str = ''
+
+
+@dataclass
+class Entry:
+    digest: str = ''
+    outputs: list[str] = field(default_factory=list)
+
+
+def hash_file(path: Path) -> str:
+    with open(path, 'rb') as file:
+        return hashlib.file_digest(file, 'blake2b').hexdigest()[:32]
+
+
+class Manifest:
+    root: Path
+    path: Path
+    entries: dict[str, Entry]
+    stamps: dict[str, FileStamp]
+    checked: set[str]
+
+
+    def __init__(self: Self, root: Path) -> None:
+        self.root = root
+        self.path = root / MANIFEST_NAME
+        self.entries = {}
+        self.stamps = {}
+        self.checked = set()
+
+        if not self.path.exists():
+            return
+
+        with open(self.path, 'rt', encoding='utf-8') as file:
+            data = json.load(file)
+
+        if data.get('version') != MANIFEST_VERSION:
+            return
+
+        self.entries = {k: Entry(**v) for k, v in data['entries'].items()}
+        self.stamps = {k: FileStamp(**v) for k, v in data['stamps'].items()}
+
+
+    def key(self: Self, path: Path) -> str:
+        if path.is_relative_to(self.root):
+            return path.relative_to(self.root).as_posix()
+        return path.as_posix()
+
+
+    def hash_input(self: Self, path: Path) -> str:
+        key = self.key(path)
+        stamp = self.stamps.get(key)
+
+        # every input is stat'ed once per run, the content is hashed only
+        # when the size or modification time has changed since the last one
+        if key in self.checked and stamp:
+            return stamp.digest
+
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            self.stamps.pop(key, None)
+            return ''
+
+        self.checked.add(key)
+        if stamp and stamp.size == stat.st_size and stamp.mtime == stat.st_mtime_ns:
+            return stamp.digest
+
+        stamp = FileStamp(stat.st_size, stat.st_mtime_ns, hash_file(path))
+        self.stamps[key] = stamp
+        return stamp.digest
+
+
+    def digest(self: Self, inputs: list[Path], *extras: str) -> str:
+        hash = hashlib.blake2b(digest_size=16)
+        for path in inputs:
+            hash.update(f'{path.name}:{self.hash_input(path)}\n'.encode())
+        for extra in extras:
+            hash.update(f'{extra}\n'.encode())
+        return hash.hexdigest()
+
+
+    def is_stale(self: Self, source: Path, digest: str) -> bool:
+        entry = self.entries.get(self.key(source))
+        if not entry or entry.digest != digest:
+            return True
+
+        return not all((self.root / x).exists() for x in entry.outputs)
+
+
+    def update(self: Self, source: Path, digest: str, outputs: list[Path]) -> list[Path]:
+        entry = Entry(
+            digest=digest,
+            outputs=sorted(self.key(x) for x in outputs)
+        )
+
+        # outputs that the converter no longer produces, e.g. after
+        # switching the output format, would otherwise be left behind
+        previous = self.entries.get(self.key(source), Entry())
+        removed = []
+
+        for output in set(previous.outputs) - set(entry.outputs):
+            path = self.root / output
+            if path.exists():
+                path.unlink()
+                removed.append(path)
+
+        # outputs can be inputs of a later task in the same run,
+        # their stamps must not be taken from before they were written
+        self.checked.difference_update(entry.outputs)
+
+        self.entries[self.key(source)] = entry
+        return removed
+
+
+    def prune(self: Self, sources: set[str] | None = None) -> list[Path]:
+        # entries of deleted sources go, and with the sources of this run
+        # given, also those no task converts anymore, e.g. the separate
+        # animations of a character after switching to grouped sprite frames
+        removed = []
+
+        for source in list(self.entries.keys()):
+            if (self.root / source).exists() and (sources is None or source in sources):
+                continue
+
+            for output in self.entries.pop(source).outputs:
+                path = self.root / output
+                if path.exists():
+                    path.unlink()
+                    removed.append(path)
+
+            self.stamps.pop(source, None)
+
+        return removed
+
+
+    def save(self: Self) -> None:
+        data = {
+            'version': MANIFEST_VERSION,
+            'entries': {k: asdict(v) for k, v in sorted(self.entries.items())},
+            'stamps': {k: asdict(v) for k, v in sorted(self.stamps.items())},
+        }
+
+        temporary = self.path.with_suffix('.tmp')
+        with open(temporary, 'wt', encoding='utf-8') as file:
+            json.dump(data, file, indent=1)
+
+        os.replace(temporary, self.path)
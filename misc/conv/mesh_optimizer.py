@@ -0,0 +1,359 @@
+import heapq
+import numpy as np
+
+from collections import deque
+from common import Geometry
+
+
+# size of the simulated FIFO post-transform cache used for the ACMR report
+ACMR_CACHE_SIZE = 16
+
+# size of the LRU cache the Forsyth scoring works with
+FORSYTH_CACHE_SIZE = 32
+
+
+def weld_vertices(geometry: Geometry) -> None:
+    if not len(geometry.vertex):
+        return
+
+    # a vertex is a row of 8 floats, welding compares the raw bytes of
+    # the whole row so only bit-identical vertices are merged
+    rows = np.concatenate([geometry.vertex, geometry.normal, geometry.texture], axis=1)
+    rows = np.ascontiguousarray(rows, dtype=np.float32)
+    keys = rows.view(np.dtype((np.void, rows.itemsize * rows.shape[1]))).ravel()
+
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+
+    # unique rows come out sorted by their bytes, put them back
+    # in the order of their first appearance in the source
+    order = np.argsort(first)
+    remap = np.empty_like(order)
+    remap[order] = np.arange(len(order))
+
+    kept = first[order]
+    geometry.vertex = geometry.vertex[kept]
+    geometry.normal = geometry.normal[kept]
+    geometry.texture = geometry.texture[kept]
+    geometry.index = remap[inverse.ravel()][geometry.index].astype(np.uint32)
+
+
+def count_cache_misses(index: np.ndarray, cache_size: int = ACMR_CACHE_SIZE) -> int:
+    cache = deque()
+    cached = set()
+    misses = 0
+
+    for vertex in index.ravel().tolist():
+        if vertex in cached:
+            continue
+
+        misses += 1
+        cache.append(vertex)
+        cached.add(vertex)
+
+        if len(cache) > cache_size:
+            cached.discard(cache.popleft())
+
+    return misses
+
+
+def compute_acmr(geometries: list[Geometry]) -> float:
+    triangles = sum(len(x.index) for x in geometries)
+    if not triangles:
+        return 0.0
+
+    misses = sum(count_cache_misses(x.index) for x in geometries)
+    return misses / triangles
+
+
+def _forsyth_score(position: int, valence: int) -> float:
+    if valence == 0:
+        return -1.0
+
+    score = 0.0
+    if position >= 3:
+        score = (1.0 - (position - 3) / (FORSYTH_CACHE_SIZE - 3)) ** 1.5
+    elif position >= 0:
+        # the last triangle gets a fixed score, so that the next one
+        # does not simply reuse the same three vertices
+        score = 0.75
+
+    return score + 2.0 * valence ** -0.5
+
+
+def optimize_vertex_cache(index: np.ndarray, vertex_count: int) -> np.ndarray:
+    # Tom Forsyth, "Linear-Speed Vertex Cache Optimisation"
+    triangles = index.tolist()
+    valence = [0] * vertex_count
+    adjacency = [[] for _ in range(vertex_count)]
+
+    for triangle, vertices in enumerate(triangles):
+        for vertex in vertices:
+            valence[vertex] += 1
+            adjacency[vertex].append(triangle)
+
+    vertex_score = [_forsyth_score(-1, x) for x in valence]
+    triangle_score = [sum(vertex_score[x] for x in vertices) for vertices in triangles]
+
+    emitted = [False] * len(triangles)
+    order = []
+    cache = []
+    next_triangle = 0
+
+    best = max(range(len(triangles)), key=triangle_score.__getitem__, default=-1)
+    while best >= 0:
+        emitted[best] = True
+        order.append(best)
+
+        for vertex in triangles[best]:
+            valence[vertex] -= 1
+            adjacency[vertex].remove(best)
+
+        cache = triangles[best] + [x for x in cache if x not in triangles[best]]
+        evicted = cache[FORSYTH_CACHE_SIZE:]
+        cache = cache[:FORSYTH_CACHE_SIZE]
+
+        for position, vertex in enumerate(cache):
+            vertex_score[vertex] = _forsyth_score(position, valence[vertex])
+        for vertex in evicted:
+            vertex_score[vertex] = _forsyth_score(-1, valence[vertex])
+
+        # only the triangles around the cached vertices changed their score
+        best = -1
+        best_score = -1.0
+        for vertex in cache:
+            for triangle in adjacency[vertex]:
+                score = sum(vertex_score[x] for x in triangles[triangle])
+                triangle_score[triangle] = score
+                if score > best_score:
+                    best, best_score = triangle, score
+
+        if best < 0:
+            while next_triangle < len(triangles) and emitted[next_triangle]:
+                next_triangle += 1
+            if next_triangle < len(triangles):
+                best = next_triangle
+
+    return index[order]
+
+
+def optimize_vertex_fetch(geometry: Geometry) -> None:
+    # vertices are stored in the order the reordered triangles first use
+    # them, unreferenced vertices are dropped
+    indices = geometry.index.ravel()
+    _, first = np.unique(indices, return_index=True)
+    used = indices[np.sort(first)]
+
+    remap = np.zeros(len(geometry.vertex), dtype=np.uint32)
+    remap[used] = np.arange(len(used), dtype=np.uint32)
+
+    geometry.vertex = geometry.vertex[used]
+    geometry.normal = geometry.normal[used]
+    geometry.texture = geometry.texture[used]
+    geometry.index = remap[geometry.index]
+
+
+def _cross(a: list[float], b: list[float], c: list[float]) -> tuple[float, float, float]:
+    u = (b[0] - a[0], b[1] - a[1], b[2] - a[2])
+    v = (c[0] - a[0], c[1] - a[1], c[2] - a[2])
+    return (
+        u[1] * v[2] - u[2] * v[1],
+        u[2] * v[0] - u[0] * v[2],
+        u[0] * v[1] - u[1] * v[0],
+    )
+
+
+def _compute_quadrics(positions: np.ndarray, index: np.ndarray) -> np.ndarray:
+    a, b, c = (positions[index[:, x]] for x in range(3))
+    normal = np.cross(b - a, c - a)
+    area = np.linalg.norm(normal, axis=1)
+    normal /= np.maximum(area, 1e-12)[:, None]
+
+    plane = np.concatenate([normal, -np.sum(normal * a, axis=1)[:, None]], axis=1)
+    quadric = plane[:, :, None] * plane[:, None, :] * area[:, None, None]
+
+    quadrics = np.zeros((len(positions), 4, 4))
+    for x in range(3):
+        np.add.at(quadrics, index[:, x], quadric)
+    return quadrics
+
+
+def _find_locked_vertices(geometry: Geometry) -> np.ndarray:
+    # welded vertices sharing a position differ in normal or uv, so they
+    # sit on a seam; together with open borders they must not move
+    positions = np.ascontiguousarray(geometry.vertex)
+    keys = positions.view(np.dtype((np.void, positions.itemsize * 3))).ravel()
+    _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    locked = counts[inverse.ravel()] > 1
+
+    index = geometry.index
+    edges = np.sort(np.concatenate([index[:, [0, 1]], index[:, [1, 2]], index[:, [2, 0]]]), axis=1)
+    edges, counts = np.unique(edges, axis=0, return_counts=True)
+    locked[edges[counts == 1].ravel()] = True
+
+    return locked
+
+
+# entries of the upper triangle of a symmetric 4x4 quadric, the terms
+# off the diagonal count twice when the error of a point is evaluated
+QUADRIC_ROWS, QUADRIC_COLUMNS = np.triu_indices(4)
+QUADRIC_WEIGHTS = np.where(QUADRIC_ROWS == QUADRIC_COLUMNS, 1.0, 2.0)
+
+
+def _quadric_error(q: list[float], point: list[float]) -> float:
+    x, y, z = point
+    return (
+        x * (q[0] * x + 2.0 * (q[1] * y + q[2] * z + q[3]))
+        + y * (q[4] * y + 2.0 * (q[5] * z + q[6]))
+        + z * (q[7] * z + 2.0 * q[8])
+        + q[9]
+    )
+
+
+def _compute_edge_errors(quadrics: np.ndarray, positions: np.ndarray, edges: np.ndarray) -> np.ndarray:
+    x, y, z = (positions[edges[:, 1], k] for k in range(3))
+    terms = np.stack([x * x, x * y, x * z, x, y * y, y * z, y, z * z, z, np.ones_like(x)], axis=1)
+    q = quadrics[edges[:, 0]] + quadrics[edges[:, 1]]
+    return np.sum(q * terms * QUADRIC_WEIGHTS, axis=1)
+
+
+def simplify_geometry(geometry: Geometry, target: int) -> Geometry:
+    # half-edge collapses ordered by quadric error, a vertex is always
+    # moved onto an existing neighbour so its normal and uv stay exact
+    positions = geometry.vertex.astype(np.float64)
+    index = geometry.index.astype(np.intp)
+    quadrics = _compute_quadrics(positions, index)[:, QUADRIC_ROWS, QUADRIC_COLUMNS]
+    locked = _find_locked_vertices(geometry)
+    points = positions.tolist()
+
+    triangles = geometry.index.tolist()
+    a, b, c = (positions[index[:, x]] for x in range(3))
+    normals = np.cross(b - a, c - a).tolist()
+
+    around = [set() for _ in range(len(points))]
+    for triangle, vertices in enumerate(triangles):
+        for vertex in vertices:
+            around[vertex].add(triangle)
+
+    removed = [False] * len(points)
+    rejected = [set() for _ in range(len(points))]
+    alive = len(triangles)
+
+    # every directed edge once, the costs of all of them in one pass
+    edges = np.concatenate([index[:, [x, y]] for x, y in ((0, 1), (1, 0), (1, 2), (2, 1), (2, 0), (0, 2))])
+    keys = np.unique(edges[:, 0].astype(np.int64) * len(points) + edges[:, 1])
+    edges = np.stack([keys // len(points), keys % len(points)], axis=1)
+    edges = edges[~locked[edges[:, 0]]]
+    errors = _compute_edge_errors(quadrics, positions, edges)
+
+    heap = [(cost, u, v) for cost, (u, v) in zip(errors.tolist(), edges.tolist())]
+    heapq.heapify(heap)
+
+    quadrics = quadrics.tolist()
+    locked = locked.tolist()
+
+    def cost(u: int, v: int) -> float:
+        q = [a + b for a, b in zip(quadrics[u], quadrics[v])]
+        return _quadric_error(q, points[v])
+
+    def push(u: int, v: int) -> None:
+        if not locked[u]:
+            heapq.heappush(heap, (cost(u, v), u, v))
+
+    def is_valid(u: int, v: int) -> bool:
+        # points never move, so the normal of a triangle only changes when
+        # one of its vertices is replaced and is kept in normals until then
+        for triangle in around[u]:
+            vertices = triangles[triangle]
+            if v in vertices:
+                continue
+
+            normal = normals[triangle]
+            a, b, c = (points[v if x == u else x] for x in vertices)
+            e = (b[0] - a[0], b[1] - a[1], b[2] - a[2])
+            f = (c[0] - a[0], c[1] - a[1], c[2] - a[2])
+            if (
+                normal[0] * (e[1] * f[2] - e[2] * f[1])
+                + normal[1] * (e[2] * f[0] - e[0] * f[2])
+                + normal[2] * (e[0] * f[1] - e[1] * f[0])
+            ) <= 0.0:
+                return False
+        return True
+
+    # collapsing only ever adds quadrics, which are positive semi-definite,
+    # so the cost of an edge can only grow; a queued cost is a lower bound
+    # that is checked when it comes out and queued again if it grew
+    while alive > target and heap:
+        queued, u, v = heapq.heappop(heap)
+        if removed[u] or removed[v]:
+            continue
+
+        current = cost(u, v)
+        if current > queued:
+            heapq.heappush(heap, (current, u, v))
+            continue
+
+        # a folding edge is tried again once either end is collapsed onto
+        if not is_valid(u, v):
+            rejected[u].add((u, v))
+            rejected[v].add((u, v))
+            continue
+
+        before = {x for t in around[v] for x in triangles[t]}
+        for triangle in list(around[u]):
+            vertices = triangles[triangle]
+            if v in vertices:
+                for vertex in vertices:
+                    around[vertex].discard(triangle)
+                alive -= 1
+            else:
+                vertices = triangles[triangle] = [v if x == u else x for x in vertices]
+                normals[triangle] = _cross(*(points[x] for x in vertices))
+                around[v].add(triangle)
+
+        around[u].clear()
+        removed[u] = True
+        quadrics[v] = [a + b for a, b in zip(quadrics[v], quadrics[u])]
+
+        # only the edges v gained from u are new, the queued edges of v
+        # are kept up to date by the check above
+        for vertex in {x for t in around[v] for x in triangles[t]} - before:
+            push(v, vertex)
+            push(vertex, v)
+
+        for edge in rejected[v] | rejected[u]:
+            push(*edge)
+        rejected[v].clear()
+        rejected[u].clear()
+
+    kept = sorted({t for x in around for t in x})
+    index = np.array([triangles[x] for x in kept], dtype=np.uint32).reshape(-1, 3)
+
+    simplified = Geometry(geometry.name, geometry.vertex, geometry.normal, geometry.texture, index)
+    optimize_vertex_fetch(simplified)
+    return simplified
+
+
+def generate_lods(geometry: Geometry, levels: int) -> list[Geometry]:
+    lods = [geometry]
+
+    for level in range(1, levels + 1):
+        target = int(len(geometry.index) * 0.5 ** level)
+        lod = simplify_geometry(lods[-1], target)
+
+        # seams and borders can stop the simplification early,
+        # a level without any change would only cost memory
+        if len(lod.index) >= len(lods[-1].index):
+            break
+
+        lods.append(lod)
+
+    return lods
+
+
+def optimize_geometry(geometry: Geometry, weld: bool = True, reorder: bool = False) -> None:
+    if weld:
+        weld_vertices(geometry)
+
+    if reorder and len(geometry.index):
+        geometry.index = optimize_vertex_cache(geometry.index, len(geometry.vertex))
+        optimize_vertex_fetch(geometry)
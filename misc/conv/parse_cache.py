@@ -0,0 +1,160 @@
+import hashlib
+import inspect
+import json
+import logging
+import numpy as np
+import os
+import sys
+import zipfile
+
+from common import CACHE_PATH, open_input, read_xml_file
+from dataclasses import fields, is_dataclass
+from pathlib import Path
+from profiling import stage
+from types import ModuleType
+from typing import Any, Callable
+
+
+PARSED_PATH = CACHE_PATH / 'parsed'
+
+# bump when the layout of the cached files changes, a change of any
+# converter module the parse function uses is already part of every cache key
+PARSED_VERSION = 1
+
+
+def _encode(value: Any, arrays: dict[str, list[np.ndarray]], name: str = '') -> Any:
+    # arrays of the same field are concatenated into one npz member,
+    # so that a trile set becomes a few members instead of thousands
+    if isinstance(value, np.ndarray):
+        key = f'{name}_{value.dtype.str}_{"x".join(map(str, value.shape[1:]))}'
+        chunks = arrays.setdefault(key, [])
+        start = sum(len(x) for x in chunks)
+        chunks.append(value)
+        return {'$array': key, 'start': start, 'stop': start + len(value)}
+
+    if is_dataclass(value):
+        data = {'$type': type(value).__name__}
+        for x in fields(value):
+            data[x.name] = _encode(getattr(value, x.name), arrays, x.name)
+        return data
+
+    if isinstance(value, dict):
+        return {k: _encode(v, arrays, k) for k, v in value.items()}
+
+    if isinstance(value, (list, tuple)):
+        return [_encode(x, arrays, name) for x in value]
+
+    return value
+
+
+def _decode(data: Any, arrays: dict[str, np.ndarray], types: dict[str, type]) -> Any:
+    if isinstance(data, list):
+        return [_decode(x, arrays, types) for x in data]
+
+    if not isinstance(data, dict):
+        return data
+
+    if '$array' in data:
+        return arrays[data['$array']][data['start']:data['stop']]
+
+    if '$type' in data:
+        kind = types[data.pop('$type')]
+        return kind(**{k: _decode(v, arrays, types) for k, v in data.items()})
+
+    return {k: _decode(v, arrays, types) for k, v in data.items()}
+
+
+def _find_parse_modules(module: ModuleType) -> list[ModuleType]:
+    # the module of the parse function and every module of the converters
+    # it takes names from, followed through their own imports in turn
+    folder = Path(module.__file__).parent
+    found = {module.__name__: module}
+    pending = [module]
+
+    while pending:
+        for value in vars(pending.pop()).values():
+            name = value.__name__ if isinstance(value, ModuleType) else getattr(value, '__module__', None)
+            other = sys.modules.get(name) if isinstance(name, str) else None
+            if other is None or other.__name__ in found or not getattr(other, '__file__', None):
+                continue
+
+            if Path(other.__file__).parent == folder:
+                found[other.__name__] = other
+                pending.append(other)
+
+    return sorted(found.values(), key=lambda x: x.__name__)
+
+
+def get_parsed_key(xml_path: Path, parse: Callable) -> str:
+    hash = hashlib.blake2b(digest_size=16)
+    hash.update(f'{PARSED_VERSION}:{parse.__module__}.{parse.__qualname__}\n'.encode())
+    # whole modules take part, the parse function calls helpers of its own
+    # module and of the ones it imports, like the xml walking of common
+    for module in _find_parse_modules(inspect.getmodule(parse)):
+        hash.update(f'{module.__name__}\n'.encode())
+        hash.update(inspect.getsource(module).encode())
+
+    with open_input(xml_path) as file:
+        hashlib.file_digest(file, lambda: hash)
+
+    return hash.hexdigest()
+
+
+def load_parsed(key: str, types: list[type]) -> Any | None:
+    json_path = PARSED_PATH / f'{key}.json'
+    npz_path = PARSED_PATH / f'{key}.npz'
+
+    try:
+        with open(json_path, 'rt', encoding='utf-8') as file:
+            data = json.load(file)
+
+        with np.load(npz_path) as npz:
+            arrays = {x: npz[x] for x in npz.files}
+    except (OSError, ValueError, zipfile.BadZipFile):
+        return None
+
+    return _decode(data, arrays, {x.__name__: x for x in types})
+
+
+def save_parsed(key: str, value: Any) -> None:
+    arrays: dict[str, list[np.ndarray]] = {}
+    data = _encode(value, arrays)
+
+    PARSED_PATH.mkdir(parents=True, exist_ok=True)
+
+    # workers may parse the same file at once, every file is written
+    # aside and moved in place, the npz first as the json marks a hit
+    for suffix, write in (
+        ('.npz', lambda x: np.savez(x, **{k: np.concatenate(v) for k, v in arrays.items()})),
+        ('.json', lambda x: x.write(json.dumps(data).encode('utf-8'))),
+    ):
+        path = PARSED_PATH / f'{key}{suffix}'
+        temporary = path.with_suffix(f'.{os.getpid()}.tmp')
+
+        with open(temporary, 'wb') as file:
+            write(file)
+
+        os.replace(temporary, path)
+
+
+def read_parsed(xml_path: Path, parse: Callable, types: list[type], cache: bool = True) -> Any:
+    if cache:
+        with stage('read'):
+            key = get_parsed_key(xml_path, parse)
+            value = load_parsed(key, types)
+
+        if value is not None:
+            logging.info('using the parsed %s from cache', xml_path.name)
+            return value
+
+    with stage('read'):
+        raw = read_xml_file(xml_path)
+
+    with stage('parse'):
+        value = parse(raw)
+
+    if cache:
+        with stage('write'):
+            save_parsed(key, value)
+
+    return value
@@ -0,0 +1,192 @@
+import queue
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, Iterator, Self
+
+
+# marks the end of the items in a queue
+DONE = object()
+
+
+@dataclass
+class QueueStats:
+    size: int = 0
+    mean: float = 0.0
+    peak: int = 0
+    items: int = 0
+
+
+class MeteredQueue(queue.Queue):
+    area: float
+    peak: int
+    items: int
+    started: float
+    changed: float
+
+
+    def __init__(self: Self, maxsize: int) -> None:
+        super().__init__(maxsize)
+        self.area = 0.0
+        self.peak = 0
+        self.items = 0
+        self.started = self.changed = time.perf_counter()
+
+
+    def _advance(self: Self) -> None:
+        # the occupancy is integrated over time, so the mean is weighted
+        # by how long the queue held each number of items
+        now = time.perf_counter()
+        self.area += len(self.queue) * (now - self.changed)
+        self.changed = now
+
+
+    def _put(self: Self, item: Any) -> None:
+        # called by put() with the mutex of the queue held, as is _get()
+        self._advance()
+        super()._put(item)
+
+        if item is not DONE:
+            self.items += 1
+            self.peak = max(self.peak, len(self.queue))
+
+
+    def _get(self: Self) -> Any:
+        self._advance()
+        return super()._get()
+
+
+    def stats(self: Self) -> QueueStats:
+        with self.mutex:
+            self._advance()
+            elapsed = self.changed - self.started
+            mean = self.area / elapsed if elapsed > 0 else 0.0
+            return QueueStats(self.maxsize, mean, self.peak, self.items)
+
+
+def completed(value: Any) -> Future:
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+class Pipeline:
+    read: Callable[[Any], Any | None]
+    convert: Callable[[Any], Future]
+    write: Callable[[Any], Any]
+    size: int
+    workers: int
+    writers: int
+    queues: dict[str, MeteredQueue]
+    stopped: threading.Event
+    error: BaseException | None
+
+
+    def __init__(self: Self, read: Callable[[Any], Any | None], convert: Callable[[Any], Future], write: Callable[[Any], Any], size: int = 8, workers: int = 1, writers: int = 2) -> None:
+        # read runs on its own thread and returns None for skipped items,
+        # convert runs on the calling thread and may hand the job over to
+        # a pool of workers, write runs on a pool of writer threads
+        self.read = read
+        self.convert = convert
+        self.write = write
+        self.size = size
+        self.workers = max(workers, 1)
+        self.writers = max(writers, 1)
+        self.queues = {}
+        self.stopped = threading.Event()
+        self.error = None
+
+
+    def _read(self: Self, items: Iterable[Any]) -> None:
+        try:
+            for item in items:
+                if self.stopped.is_set():
+                    break
+
+                job = self.read(item)
+                if job is not None:
+                    self.queues['convert'].put(job)
+        except BaseException as error:
+            self.error = error
+        finally:
+            self.queues['convert'].put(DONE)
+
+
+    def _write(self: Self) -> None:
+        for result, written in iter(self.queues['write'].get, DONE):
+            try:
+                written.set_result(self.write(result))
+            except BaseException as error:
+                written.set_exception(error)
+
+
+    def run(self: Self, items: Iterable[Any]) -> Iterator[Any]:
+        # yields what write returns in the order of the items
+        self.queues = {
+            'convert': MeteredQueue(self.size),
+            'write': MeteredQueue(self.size),
+        }
+        self.stopped.clear()
+        self.error = None
+
+        reader = threading.Thread(target=self._read, args=(items,), name='reader', daemon=True)
+        writers = [
+            threading.Thread(target=self._write, name=f'writer-{x}', daemon=True)
+            for x in range(self.writers)
+        ]
+
+        reader.start()
+        for writer in writers:
+            writer.start()
+
+        converting: deque[Future] = deque()
+        writing: deque[Future] = deque()
+
+        def hand_over() -> None:
+            written = Future()
+            self.queues['write'].put((converting.popleft().result(), written))
+            writing.append(written)
+
+        try:
+            for job in iter(self.queues['convert'].get, DONE):
+                converting.append(self.convert(job))
+
+                # the oldest job is waited for only once one more than the
+                # pool can take is submitted, so no worker is left idle
+                while converting and (len(converting) > self.workers or converting[0].done()):
+                    hand_over()
+
+                while writing and writing[0].done():
+                    yield writing.popleft().result()
+
+            if self.error:
+                raise self.error
+
+            while converting:
+                hand_over()
+
+            while writing:
+                yield writing.popleft().result()
+        finally:
+            # an interrupted run lets the reader finish its current item
+            # and the writers finish the results already handed to them
+            self.stopped.set()
+            while reader.is_alive():
+                try:
+                    self.queues['convert'].get(timeout=0.05)
+                except queue.Empty:
+                    pass
+
+            for _ in writers:
+                self.queues['write'].put(DONE)
+            for writer in writers:
+                writer.join()
+
+
+    def occupancy(self: Self) -> dict[str, QueueStats]:
+        # queues are named by the stage that takes items out of them,
+        # a queue that is mostly full waits for that stage to catch up
+        return {name: x.stats() for name, x in self.queues.items()}
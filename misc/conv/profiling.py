@@ -0,0 +1,84 @@
+import cProfile
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Iterator
+
+
+STAGES = ['read', 'parse', 'convert', 'build', 'render', 'write']
+
+
+@dataclass
+class StageProfile:
+    seconds: float = 0.0
+    peak: int = 0
+
+
+@dataclass
+class Profile:
+    seconds: float = 0.0
+    peak: int = 0
+    stages: dict[str, StageProfile] = field(default_factory=dict)
+
+
+# profile of the asset being converted by this process,
+# stages are recorded only while one is active
+ACTIVE_PROFILE: Profile | None = None
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    profile = ACTIVE_PROFILE
+    if profile is None:
+        yield
+        return
+
+    # the peak counts only memory allocated on top of what was already
+    # live when the stage started, stages of the same name are summed up,
+    # e.g. one render per locale
+    tracemalloc.reset_peak()
+    current = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        peak = tracemalloc.get_traced_memory()[1]
+        profile.peak = max(profile.peak, peak)
+
+        record = profile.stages.setdefault(name, StageProfile())
+        record.seconds += time.perf_counter() - start
+        record.peak = max(record.peak, peak - current)
+
+
+@contextmanager
+def profile_asset(dump_path: Path | None = None) -> Iterator[Profile]:
+    global ACTIVE_PROFILE
+
+    profile = Profile()
+    profiler = cProfile.Profile() if dump_path else None
+
+    tracemalloc.start()
+    ACTIVE_PROFILE = profile
+    start = time.perf_counter()
+
+    if profiler:
+        profiler.enable()
+
+    try:
+        yield profile
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(dump_path)
+
+        profile.seconds = time.perf_counter() - start
+        # stages reset the peak, the one of the whole asset is
+        # the highest of theirs and of what came after the last one
+        profile.peak = max(profile.peak, tracemalloc.get_traced_memory()[1])
+
+        ACTIVE_PROFILE = None
+        tracemalloc.stop()
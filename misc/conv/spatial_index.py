@@ -0,0 +1,250 @@
+import json
+import numpy as np
+import struct
+
+from common import write_output
+from pathlib import Path
+from typing import Any, Iterator, Self
+
+
+# a level's spatial index is a header, an open addressing hash table
+# of fixed size records keyed by the trile cell and the string tables
+# the records refer to, so the table can be memory mapped as it is
+MAGIC = b'KSPI'
+VERSION = 1
+
+# magic, version, capacity, count, offset and length of the tables, bounds
+HEADER = struct.Struct('<4sIIIII6h')
+HEADER_SIZE = 64
+
+RECORD = np.dtype([
+    ('key', '<i8'),
+    ('trile', '<i4'),
+    ('size', '<f4', 3),
+    ('orientation', 'u1'),
+    ('surface', 'u1'),
+    ('flags', 'u1'),
+    ('collision', 'u1', 6),
+    ('reserved', 'u1', 7),
+])
+
+# sides of a trile in the order of common.NORMALS, collision
+# types of the records are stored for the sides in the level
+FACES = ['Left', 'Down', 'Back', 'Right', 'Top', 'Front']
+
+STEPS = [(-1, 0, 0), (0, -1, 0), (0, 0, -1), (1, 0, 0), (0, 1, 0), (0, 0, 1)]
+
+FLAG_IMMATERIAL = 1
+FLAG_SEE_THROUGH = 2
+FLAG_HAS_MESH = 4
+
+EMPTY_KEY = -1
+
+# the table is at most half full, which keeps probe sequences short
+MAX_LOAD = 0.5
+
+MASK_64 = (1 << 64) - 1
+
+
+def pack_key(x: int, y: int, z: int) -> int:
+    return ((x + 32768) << 32) | ((y + 32768) << 16) | (z + 32768)
+
+
+def pack_keys(position: np.ndarray) -> np.ndarray:
+    cells = position.astype(np.int64) + 32768
+    return (cells[:, 0] << 32) | (cells[:, 1] << 16) | cells[:, 2]
+
+
+def hash_key(key: int) -> int:
+    # the finalizer of murmur3, the same as hash_keys for a single key
+    key ^= key >> 33
+    key = (key * 0xff51afd7ed558ccd) & MASK_64
+    key ^= key >> 33
+    key = (key * 0xc4ceb9fe1a85ec53) & MASK_64
+    return key ^ (key >> 33)
+
+
+def hash_keys(keys: np.ndarray) -> np.ndarray:
+    keys = keys.astype(np.uint64)
+    keys ^= keys >> np.uint64(33)
+    keys *= np.uint64(0xff51afd7ed558ccd)
+    keys ^= keys >> np.uint64(33)
+    keys *= np.uint64(0xc4ceb9fe1a85ec53)
+    return keys ^ (keys >> np.uint64(33))
+
+
+def build_table(records: np.ndarray) -> np.ndarray:
+    capacity = 1 << max(int(np.ceil(np.log2(max(len(records), 1) / MAX_LOAD))), 4)
+    mask = np.uint64(capacity - 1)
+
+    table = np.zeros(capacity, dtype=RECORD)
+    table['key'] = EMPTY_KEY
+
+    # linear probing done for all records at once, every round the first
+    # record waiting for a free slot takes it and the others move on
+    slots = (hash_keys(records['key']) & mask).astype(np.int64)
+    pending = np.arange(len(records))
+
+    while len(pending):
+        free = pending[table['key'][slots[pending]] == EMPTY_KEY]
+        _, first = np.unique(slots[free], return_index=True)
+        placed = free[first]
+        table[slots[placed]] = records[placed]
+
+        pending = np.setdiff1d(pending, placed, assume_unique=True)
+        slots[pending] = (slots[pending] + 1) & (capacity - 1)
+
+    return table
+
+
+def write_spatial_index(path: Path, records: np.ndarray, tables: dict[str, list[str]]) -> None:
+    # cells are unique, a later record of the same cell is dropped
+    _, first = np.unique(records['key'], return_index=True)
+    records = records[np.sort(first)]
+    table = build_table(records)
+
+    position = np.column_stack([
+        (records['key'] >> 32) & 0xFFFF,
+        (records['key'] >> 16) & 0xFFFF,
+        records['key'] & 0xFFFF,
+    ]) - 32768
+    bounds = [*position.min(axis=0).tolist(), *position.max(axis=0).tolist()] if len(records) else [0] * 6
+
+    blob = json.dumps(tables, separators=(',', ':')).encode('utf-8')
+    offset = HEADER_SIZE + table.nbytes
+    header = HEADER.pack(MAGIC, VERSION, len(table), len(records), offset, len(blob), *bounds)
+
+    write_output(path, [header.ljust(HEADER_SIZE, b'\0'), memoryview(table).cast('B'), blob])
+
+
+class SpatialIndex:
+    path: Path
+    capacity: int
+    count: int
+    bounds: tuple[tuple[int, int, int], tuple[int, int, int]]
+    tables: dict[str, list[str]]
+    records: np.ndarray
+    keys: np.ndarray
+
+
+    def __init__(self: Self, path: Path) -> None:
+        self.path = Path(path)
+
+        with open(self.path, 'rb') as file:
+            magic, version, capacity, count, offset, length, *bounds = HEADER.unpack(file.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f'{self.path.name} is not a spatial index of version {VERSION}')
+
+            file.seek(offset)
+            self.tables = json.loads(file.read(length))
+
+        self.capacity = capacity
+        self.count = count
+        self.bounds = (tuple(bounds[:3]), tuple(bounds[3:]))
+        self.records = np.memmap(self.path, dtype=RECORD, mode='r', offset=HEADER_SIZE, shape=(capacity,))
+        self.keys = self.records['key']
+
+
+    def __len__(self: Self) -> int:
+        return self.count
+
+
+    def __enter__(self: Self) -> Self:
+        return self
+
+
+    def __exit__(self: Self, *args) -> None:
+        self.close()
+
+
+    def close(self: Self) -> None:
+        # dropping the views unmaps the file once nothing else holds them
+        self.records = self.keys = None
+
+
+    def find_slot(self: Self, x: int, y: int, z: int) -> int:
+        key = pack_key(x, y, z)
+        mask = self.capacity - 1
+        slot = hash_key(key) & mask
+
+        while True:
+            found = int(self.keys[slot])
+            if found == key:
+                return slot
+            if found == EMPTY_KEY:
+                return -1
+            slot = (slot + 1) & mask
+
+
+    def lookup(self: Self, x: int, y: int, z: int) -> np.void | None:
+        slot = self.find_slot(x, y, z)
+        return self.records[slot] if slot >= 0 else None
+
+
+    def lookup_many(self: Self, position: np.ndarray) -> np.ndarray:
+        # slots of many cells probed together, -1 where a cell is empty
+        keys = pack_keys(position)
+        mask = self.capacity - 1
+        slots = (hash_keys(keys) & np.uint64(mask)).astype(np.int64)
+        found = np.full(len(keys), -1, dtype=np.int64)
+        pending = np.arange(len(keys))
+
+        while len(pending):
+            stored = self.keys[slots[pending]]
+            hit = stored == keys[pending]
+            found[pending[hit]] = slots[pending[hit]]
+
+            pending = pending[~hit & (stored != EMPTY_KEY)]
+            slots[pending] = (slots[pending] + 1) & mask
+
+        return found
+
+
+    def walk(self: Self, x: int, y: int, z: int, side: int, solid: bool = True) -> Iterator[tuple[int, np.void]]:
+        # records met stepping from the cell towards a side with their
+        # distance, until the walk leaves the bounds of the level
+        axis = side % 3
+        step = STEPS[side][axis]
+        cell = [x, y, z]
+        low, high = self.bounds
+
+        if any(not low[i] <= cell[i] <= high[i] for i in range(3) if i != axis):
+            return
+
+        end = high[axis] if step > 0 else low[axis]
+        distance = 0
+
+        while (end - cell[axis]) * step > 0:
+            cell[axis] += step
+            distance += 1
+
+            record = self.lookup(*cell)
+            if record is not None and not (solid and record['flags'] & FLAG_IMMATERIAL):
+                yield distance, record
+
+
+    def below(self: Self, x: int, y: int, z: int, solid: bool = True) -> np.void | None:
+        return next((record for _, record in self.walk(x, y, z, 1, solid)), None)
+
+
+    def nearest_along(self: Self, x: int, y: int, z: int, side: int, solid: bool = True) -> tuple[int, np.void] | None:
+        return next(self.walk(x, y, z, side, solid), None)
+
+
+    def describe(self: Self, record: np.void) -> dict[str, Any]:
+        key = int(record['key'])
+        return {
+            'position': ((key >> 32) - 32768, ((key >> 16) & 0xFFFF) - 32768, (key & 0xFFFF) - 32768),
+            'trile': int(record['trile']),
+            'orientation': int(record['orientation']),
+            'surface': self.tables['surfaces'][record['surface']],
+            'immaterial': bool(record['flags'] & FLAG_IMMATERIAL),
+            'seeThrough': bool(record['flags'] & FLAG_SEE_THROUGH),
+            'hasMesh': bool(record['flags'] & FLAG_HAS_MESH),
+            'collisionFaces': {
+                face: self.tables['collisions'][x]
+                for face, x in zip(FACES, record['collision'].tolist())
+            },
+            'collisionSize': tuple(record['size'].tolist()),
+        }
+
@@ -0,0 +1,78 @@
+@tool
+extends EditorScenePostImport
+
+## Applies what the converters in misc/conv store as glTF extras,
+## which the glTF importer leaves out of the imported scene
+
+
+func _post_import(scene: Node) -> Object:
+	var gltf := _read_gltf_json(get_source_file())
+	var asset: Dictionary = gltf.get('asset', {})
+	if asset.get('generator') != 'kompass':
+		return scene
+
+	var extras: Dictionary = asset.get('extras', {})
+	# a trile set describes every trile by its name
+	if not extras.is_empty() and extras.values().all(func(x): return x is Dictionary and x.has('meshId')):
+		_save_mesh_library(scene, extras, get_source_file().get_basename() + '.meshlib.tres')
+
+	for node in gltf.get('nodes', []):
+		if node.get('extras', {}).has('visibility_range_begin'):
+			_apply_visibility_range(scene, node['name'], node['extras'])
+
+	return scene
+
+
+## Only the json of a glTF is read, for a binary glTF it is the first chunk
+func _read_gltf_json(path: String) -> Dictionary:
+	var text := ''
+	if path.get_extension() == 'glb':
+		var file := FileAccess.open(path, FileAccess.READ)
+		if file == null:
+			return {}
+
+		file.seek(12)
+		var length := file.get_32()
+		file.seek(20)
+		text = file.get_buffer(length).get_string_from_utf8()
+	else:
+		text = FileAccess.get_file_as_string(path)
+
+	var data = JSON.parse_string(text)
+	return data if data is Dictionary else {}
+
+
+## Item ids are the indices of the triles in the trile set, which is
+## how the level converter maps trile ids to the cells of its grid maps
+func _save_mesh_library(scene: Node, triles: Dictionary, path: String) -> void:
+	var library := MeshLibrary.new()
+
+	for name in triles:
+		var trile: Dictionary = triles[name]
+		var id := int(trile['meshId'])
+		library.create_item(id)
+		library.set_item_name(id, name)
+
+		var node := scene.find_child(String(name).validate_node_name(), true, false) as MeshInstance3D
+		if node:
+			library.set_item_mesh(id, node.mesh)
+
+		var size: Array = trile['collisionSize']
+		var shape := BoxShape3D.new()
+		shape.size = Vector3(size[0], size[1], size[2])
+		library.set_item_shapes(id, [shape, Transform3D()])
+
+	var error := ResourceSaver.save(library, path)
+	if error != OK:
+		push_error('Cannot save the mesh library %s: %s' % [path, error_string(error)])
+
+
+## Levels of detail are sibling nodes, each one drawn only within its range
+func _apply_visibility_range(scene: Node, name: String, extras: Dictionary) -> void:
+	var node := scene.find_child(name.validate_node_name(), true, false) as GeometryInstance3D
+	if node == null:
+		push_warning('Cannot find the level of detail %s' % name)
+		return
+
+	node.visibility_range_begin = extras['visibility_range_begin']
+	node.visibility_range_end = extras['visibility_range_end']